@@ -14,26 +14,107 @@ https://en.wikipedia.org/wiki/Reverse_Polish_notation
 
 Functions
 ---------
-append_stack(float(number))  
+new_session(list(budget))
+new_budget(int(line_length), int(tokens), int(operations),
+    float(line_seconds), int(comment_length), int(session_operations),
+    float(session_seconds))
+append_stack(float(number), list(stack))
 check_saturation(float(number))
-process_octal_number(str(number_str))
-process_number(str(number_str))
-display_stack()
-process_equals()
-process_rand_number(str(rand_number_str))
-process_arithmetic_operator(str(operator))
+process_octal_number(str(number_str), list(stack))
+convert_number(str(number_str))
+process_number(str(number_str), list(stack))
+display_stack(list(stack), list(output_events))
+process_equals(list(stack), list(output_events))
+process_rand_number(str(rand_number_str), list(stack),
+    list(program_status))
+process_power(float(x), float(y))
+calculate_operator(str(operator), float(x), float(y))
+process_arithmetic_operator(str(operator), list(stack))
 op_precedence_change(str(current_op), str(previous_op))
 parse_comment(str(command), int(command_index), 
     boolean(comment_flag) str(comment_string)) 
 parse_number(str(command), int(command_index))
-parse_command_line(str(command))
-process_command(str(command))
+parse_command_line(str(command), list(program_status))
+stack_effect(list(rpn_elements))
+render_events(list(output_events))
+process_tokens(list(rpn_elements), list(session), list(output_events))
+process_tokens_checked(list(rpn_elements), list(session),
+    list(output_events))
+process_tokens_unchecked(list(rpn_elements), list(session),
+    list(output_events))
+process_command(str(command), list(session))
+govern_command(str(command), list(session), list(output_events))
+process_command_governed(str(command), list(session))
+snapshot_session(list(session))
+restore_session(list(session), tuple(snapshot))
+process_command_with_history(str(command), list(session))
+undo_command(list(session))
+branch_session(list(session))
+process_command_speculative(str(command), list(session))
+iter_tokens(iterable(lines), list(program_status))
+scan_comment_state(list(lines), boolean(comment_flag), str(comment_string))
+tokenize_chunk(list(lines), boolean(comment_flag), str(comment_string))
+iter_tokens_parallel(iterable(lines), executor, list(program_status),
+    int(chunk_size), int(max_pending))
+iter_results(iterable(token_lists), list(session))
+iter_output(iterable(results))
+process_commands_quietly(iterable(commands), list(session))
+process_locked_command(list(session), str(command))
+process_session_commands(list(session), list(commands))
+submit_command(executor, list(session), str(command))
+map_commands(executor, iterable(jobs))
+generate_token_source(list(rpn_elements), boolean(checked))
+generate_command_source(list(rpn_elements))
+specialize_command(str(command))
+process_command_specialized(str(command), list(session))
+encode_varint(int(number))
+decode_varint(bytes(data), int(position))
+encode_trace_text(str(text))
+decode_trace_text(bytes(data), int(position))
+new_trace_recorder(file(trace_file), list(session),
+    int(checkpoint_interval), int(flush_size))
+write_trace_checkpoint(list(recorder))
+flush_trace(list(recorder))
+process_command_recorded(str(command), list(recorder))
+decode_trace_checkpoint(bytes(data), int(position))
+replay_trace(bytes(data), process, int(max_divergences))
+replay_main(list(args))
+generate_workload_element(Random(generator), dict(mix))
+generate_workload(int(line_count), seed, dict(mix), int(max_line_elements))
+run_benchmark(list(lines), list(session), process)
+measure_history_memory(int(entries), int(depth))
+measure_store_memory(int(capacity))
+bench_main(list(args))
+
+new_session_store(int(capacity))
+load_session(list(store), int(slot), list(session))
+save_session(list(store), int(slot), list(session))
+process_store_command(list(store), int(slot), str(command),
+    list(session))
 
 Misc Variables
 --------------
 stack = []
 program_status = [int(random_index), 
     boolean(multiline_comment_flag), str(previous_comment_string)]
+default_session = [list(stack), list(program_status), Lock(),
+    tuple(history), list(budget), list(usage)]
+
+Thread safety
+-------------
+All calculator state lives in a session list, the defs only touch the
+session they are given. Different sessions can be actioned from any
+number of threads at the same time. A single session is NOT safe to
+share between threads without holding its lock, which the executor
+defs (submit_command, map_commands) do for you. process_command() with
+no session uses default_session and is for the single threaded
+command line entry point only.
+
+The one exception is process_command_specialized(), which shares its
+compiled command cache between all sessions. The cache is only changed
+while holding specialize_lock, so it is also safe to use from any
+thread. Commands are compiled without holding the lock, and once the
+cache is full the lock is no longer taken.
 """
 
 #               Python v3.8
@@ -46,6 +127,35 @@ program_status = [int(random_index),
 # ref: https://docs.python.org/3.8/library/typing.html
 from typing import Final
 
+# per session lock used by the executor defs
+from threading import Lock
+
+# clock used by the resource budget time limits
+from time import perf_counter
+
+# typed arrays packing many sessions into one session store
+from array import array
+
+# chunks waiting for their parallel lexing results
+from collections import deque
+
+# matches the digits of a number literal
+import re
+
+# packs stack values into binary trace records
+from struct import Struct
+from struct import error as struct_error
+
+# command line arguments for the command line tools
+import sys
+from argparse import ArgumentParser
+
+# seeded generator for synthetic benchmark workloads
+from random import Random
+
+# measures the memory used by history and session store benchmarks
+import tracemalloc
+
 # stack limit constant
 stack_limit: Final = 23
 
@@ -71,14 +181,45 @@ valid_number_digits: Final = [
     "9",
     "r",
 ]
+# only ASCII digits, str.isdigit() also accepts other unicode digits
+decimal_digits_pattern: Final = re.compile("[0-9]*")
+# longest digit strings that can hold a value inside the saturation
+# range, literals with more significant digits always saturate
+max_decimal_digits: Final = len(str(max_nr))
+max_octal_digits: Final = len(oct(max_nr)) - 2
 
 # error message literals
-unrecognised_op_msg: Final = 'Unrecognised operator or operand "%".\n'
+unrecognised_op_msg: Final = 'Unrecognised operator or operand "{}".\n'
 stack_overflow_msg: Final = "Stack overflow.\n"
 stack_empty_msg: Final = "Stack empty.\n"
 stack_underflow_msg: Final = "Stack underflow.\n"
 zero_divide_msg: Final = "Divide by 0.\n"
 negative_power_msg: Final = "Negative power.\n"
+budget_exceeded_msg: Final = "Budget exceeded.\n"
+
+# output event codes returned by the process_* defs. Handlers only
+# return these codes (or append (code, payload) events); text is built
+# from them by render_events() once the whole command has been actioned
+no_error: Final = 0
+stack_overflow_error: Final = 1
+stack_empty_error: Final = 2
+stack_underflow_error: Final = 3
+zero_divide_error: Final = 4
+negative_power_error: Final = 5
+unrecognised_op_error: Final = 6
+#   value output event from '=' or 'd', payload is the stack value
+value_event: Final = 7
+budget_exceeded_error: Final = 8
+
+# error code to message literal lookup used by render_events()
+error_messages: Final = {
+    stack_overflow_error: stack_overflow_msg,
+    stack_empty_error: stack_empty_msg,
+    stack_underflow_error: stack_underflow_msg,
+    zero_divide_error: zero_divide_msg,
+    negative_power_error: negative_power_msg,
+    budget_exceeded_error: budget_exceeded_msg,
+}
 
 arithmetic_operators: Final = ["-", "+", "*", "/", "%", "^"]
 equals_operator: Final = "="
@@ -86,7 +227,8 @@ rand_number_operator: Final = "r"
 display_stack_operator: Final = "d"
 comment_operator: Final = "#"
 
-# psuedo random numbers returned in sequence with <r> operator
+# psuedo random numbers returned in sequence with <r> operator, the
+# sequence repeats from the first number after the last
 random_number: Final = [
     1804289383,
     846930886,
@@ -110,7 +252,6 @@ random_number: Final = [
     1303455736,
     35005211,
     521595368,
-    1804289383,
 ]
 
 #               define global variables
@@ -128,24 +269,194 @@ multiline_comment_flag: Final = 1
 #   [2] is multiline comment string, default =""
 previous_comment_string: Final = 2
 
+# contains a calculator session:
+#   [stack, program_status, lock, history, budget, usage]
+# constants to access each session setting
+#   [0] is the session stack list
+session_stack: Final = 0
+#   [1] is the session program status list
+session_status: Final = 1
+#   [2] is the lock held while an executor job actions the session
+session_lock: Final = 2
+#   [3] is the undo history, None or a (snapshot, previous history) cell.
+#   Cells are never changed once made so branches share their history
+session_history: Final = 3
+#   [4] is the resource budget list from new_budget(), None for no limits
+session_budget: Final = 4
+#   [5] is the resources used by the session: [operations, seconds]
+session_usage: Final = 5
+
+# contains resource budget settings, each None for no limit
+# constants to access each budget setting
+#   [0] is the most characters in a command line
+budget_line_length: Final = 0
+#   [1] is the most tokens parsed from a command line
+budget_tokens: Final = 1
+#   [2] is the most tokens actioned from a command line
+budget_operations: Final = 2
+#   [3] is the most seconds spent actioning a command line
+budget_line_seconds: Final = 3
+#   [4] is the most characters kept from an unclosed multiline comment
+budget_comment_length: Final = 4
+#   [5] is the most tokens actioned over the life of the session
+budget_session_operations: Final = 5
+#   [6] is the most seconds spent actioning commands over the session
+budget_session_seconds: Final = 6
+
+# number of tokens actioned between checks of the time budgets
+budget_check_interval: Final = 64
+
+# contains a session store packing the state of many sessions, each
+# identified by its slot number, into typed arrays:
+#   [values, depths, random indexes, comment flags, comment strings]
+# constants to access each store setting
+#   [0] is a double array of stack_limit stack values per slot
+store_values: Final = 0
+#   [1] is a byte array of the stack depth of each slot
+store_depths: Final = 1
+#   [2] is a byte array of the random number index of each slot
+store_random_indexes: Final = 2
+#   [3] is a byte array of the multiline comment flag of each slot
+store_comment_flags: Final = 3
+#   [4] is a dict of slot to comment string, only for open comments
+store_comment_strings: Final = 4
+
+# binary trace file header and record types
+trace_magic: Final = b"SRPN\x01"
+#   command record: command text and the output it produced
+trace_command_record: Final = 1
+#   checkpoint record: commands and seconds so far plus session state
+trace_checkpoint_record: Final = 2
+# packs one stack value or a seconds count into a trace
+trace_double: Final = Struct("<d")
+
+# relative weights of each kind of element in a generated workload
+workload_mix: Final = {
+    "number": 30,
+    "operator": 25,
+    "display": 8,
+    "saturating": 4,
+    "octal": 5,
+    "random": 5,
+    "compact": 10,
+    "comment": 5,
+    "error": 8,
+}
+
+# contains a trace recorder settings:
+#   [file, session, checkpoint interval, commands, seconds, buffer,
+#    flush size]
+# constants to access each recorder setting
+#   [0] is the binary file the trace is appended to
+recorder_file: Final = 0
+#   [1] is the session the recorded commands are actioned on
+recorder_session: Final = 1
+#   [2] is the number of commands between checkpoint records
+recorder_interval: Final = 2
+#   [3] is the number of commands recorded
+recorder_commands: Final = 3
+#   [4] is the seconds spent actioning the recorded commands
+recorder_seconds: Final = 4
+#   [5] is the bytearray of records not yet written to the file
+recorder_buffer: Final = 5
+#   [6] is the buffered bytes that cause a write, 0 writes every command
+recorder_flush_size: Final = 6
+
+# session used by the command line entry point and by process_command()
+# when no session is given, wraps the stack and program_status globals
+default_session = [stack, program_status, Lock(), None, None, [0, 0.0]]
+
+# number of times a command must be seen by process_command_specialized()
+# before it is compiled into a specialized python function
+specialize_threshold: Final = 8
+# maximum number of commands held in the specialized command cache
+specialize_cache_limit: Final = 4096
+# most tokens in a specialized command, compile time grows faster than
+# the command so longer commands are always interpreted
+specialize_token_limit: Final = 256
+
+# specialized command cache, command string key to
+# [function, comment_flag, comment_string] after the command, function
+# is None for a command over specialize_token_limit
+specialized_commands = {}
+# times each command not yet specialized has been seen
+command_hotness = {}
+# held while either of the two dicts above is changed
+specialize_lock = Lock()
+
+# python expression used by specialized code for each arithmetic operator
+operator_expressions: Final = {
+    "+": "x + y",
+    "-": "x - y",
+    "*": "x * y",
+    "/": "x / y",
+    "%": "x % y",
+    "^": "process_power(x, y)",
+}
+
 
 #                               SRPN def's
-def append_stack(number):
+def new_session(budget=None):
+    """
+    <budget> = resource budget list from new_budget(), None for no limits
+
+    Creates a calculator session with an empty stack and default
+    program status settings, independent of every other session
+
+    Returns: <session> list [stack, program_status, lock, history,
+    budget, usage]
+    """
+    return [[], [0, False, ""], Lock(), None, budget, [0, 0.0]]
+
+
+def new_budget(
+    line_length=None,
+    tokens=None,
+    operations=None,
+    line_seconds=None,
+    comment_length=None,
+    session_operations=None,
+    session_seconds=None,
+):
+    """
+    Args, each None for no limit:
+    <line_length> (int) = most characters in a command line,
+    <tokens> (int) = most tokens parsed from a command line,
+    <operations> (int) = most tokens actioned from a command line,
+    <line_seconds> (float) = most seconds actioning a command line,
+    <comment_length> (int) = most characters kept from an unclosed
+    multiline comment, the rest of the comment text is dropped,
+    <session_operations> (int) = most tokens actioned by the session,
+    <session_seconds> (float) = most seconds actioning session commands
+
+    Returns: <budget> list of the settings for new_session()
+    """
+    return [
+        line_length,
+        tokens,
+        operations,
+        line_seconds,
+        comment_length,
+        session_operations,
+        session_seconds,
+    ]
+
+
+def append_stack(number, stack):
     """
     <number> = float value
+    <stack> = session stack list
 
     Checks if stack will overflow otherwise appends <number> to stack
-    as string value
 
-    Returns: <string> empty or contains "Error message"
+    Returns: <int> error code, no_error or stack_overflow_error
     """
     # check if adding number would overflow the stack
     if len(stack) + 1 > stack_limit:
-        return stack_overflow_msg
+        return stack_overflow_error
 
-    # stack.append(str(number))
     stack.append(number)
-    return ""
+    return no_error
 
 
 def check_saturation(number):
@@ -164,9 +475,10 @@ def check_saturation(number):
     return min(number, max_nr)
 
 
-def process_octal_number(number_str):
+def process_octal_number(number_str, stack):
     """
     <number> = Str value
+    <stack> = session stack list
 
     Check <number> in non decimal base format and converts
     to decimal (base 10) value
@@ -175,99 +487,129 @@ def process_octal_number(number_str):
     all digits less than 7. E.g. 01101 is 557 in decimal or
     -01101 which -557
     If its an illegal Octal value eg has 8 or 9 digits then
-    return None
-
-    """
-    oCtal = ""
+    the number is ignored
 
-    # check for illegal digits for Octal number
-    for x in ["8", "9"]:
-        if number_str.count(x):
-            return None
+    Numbers with more significant digits than any value in the
+    saturation range are saturated without being converted
 
-    # replace leading zero with 0o to signal
-    # python this is Octal value
+    Returns: <int> error code, no_error or stack_overflow_error
+    """
     if number_str.startswith("0"):
-        oCtal = "0o" + number_str[1:]
+        digits = number_str[1:]
     elif number_str.startswith("-0"):
-        oCtal = "-0o" + number_str[2:]
+        digits = number_str[2:]
     else:
-        return None
+        return no_error
+
+    # check for illegal digits for Octal number, strip() only leaves
+    # characters if a non Octal digit is found
+    if digits.strip("01234567"):
+        return no_error
+
+    digits = digits.lstrip("0")
+
+    if len(digits) > max_octal_digits:
+        if number_str.startswith("-"):
+            return append_stack(min_nr, stack)
+        return append_stack(max_nr, stack)
+
+    number = int(digits or "0", base=8)
+    if number_str.startswith("-"):
+        number = -number
 
     # return Octal value converted to decimal
-    return append_stack(check_saturation(int(oCtal, base=8)))
+    return append_stack(check_saturation(number), stack)
 
 
-def process_number(number_str):
+def convert_number(number_str):
     """
-    <number> = string NUMBER value
+    <number_str> = string NUMBER value from parse_number(), an optional
+    '-' followed by digits
 
-    Pushes the number onto the stack, first checking for number saturation,
-    and stack overflow situation
+    Converts <number_str> to a saturated value. Numbers with more
+    significant digits than any value in the saturation range are
+    saturated without being converted
 
-    Returns: <string> empty or contains "Error message"
+    Returns: <number>
     """
+    if len(number_str.lstrip("-0")) > max_decimal_digits:
+        if number_str.startswith("-"):
+            return min_nr
+        return max_nr
 
-    try:
-        # append value to stack retaining float accuracy
-        return append_stack(check_saturation(float(number_str)))
-    except:
-        return ""
+    # retain float accuracy
+    return check_saturation(float(number_str))
+
+
+def process_number(number_str, stack):
+    """
+    <number> = string NUMBER value
+    <stack> = session stack list
 
+    Pushes the number onto the stack, first checking for number saturation,
+    and stack overflow situation. <number_str> comes from parse_number()
+    so always holds an optional '-' followed by digits
 
-def display_stack():
+    Returns: <int> error code, no_error or stack_overflow_error
     """
-    Concatentates stack values with '\\n' delimiters
-    trailing each item into a string value
+    return append_stack(convert_number(number_str), stack)
+
 
-    Returns: <string> or '-2147483648' if stack is empty
+def display_stack(stack, output_events):
     """
-    return_value = ""
+    <stack> = session stack list
+    <output_events> = list of (code, payload) output events
 
+    Appends a value_event for each stack value, bottom first, to
+    <output_events> or a single '-2147483648' value if stack is empty
+
+    Returns: <int> error code, always no_error
+    """
     if len(stack) == 0:
-        return_value = str(min_nr) + "\n"
+        output_events.append((value_event, min_nr))
     else:
-        # insert newline control between stack entries
-        # and convert to INT to format correctly on output
         for item in stack:
-            return_value += str(int(float(item))) + "\n"
+            output_events.append((value_event, item))
 
-    return return_value
+    return no_error
 
 
-def process_equals():
+def process_equals(stack, output_events):
     """
-    Copies last stack value into string with trailing '\\n'
+    <stack> = session stack list
+    <output_events> = list of (code, payload) output events
+
+    Appends a value_event for the last stack value to <output_events>
 
-    Returns: <string> or error message if stack is empty
+    Returns: <int> error code, no_error or stack_empty_error
     """
 
     if len(stack) == 0:
-        return stack_empty_msg
+        return stack_empty_error
 
-    # insert newline control between stack entries
-    # and convert to INT to format correctly on output
-    return str(int(float(stack[-1]))) + "\n"
+    output_events.append((value_event, stack[-1]))
+    return no_error
 
 
-def process_rand_number(rand_number_str):
+def process_rand_number(rand_number_str, stack, program_status):
     """
     Arg:
     <rand_number_str>  = string with rand nr command. Used to
     check for leading '-'
+    <stack> = session stack list
+    <program_status> = session program status list
 
     Adds the next random number in sequence from a list of pseudo
     random numbers to the stack.
 
-    Numbers wrap around after the stack limit is reach starting from the
-    begining of the list again
+    Numbers wrap around after the end of the list is reached starting
+    from the begining of the list again
 
-    Returns: <string> empty or contains "Error message"
+    Returns: <int> error code, no_error or stack_overflow_error
     """
-    # identify index as global variable so can be updated
+    # take a copy of the session index so can be updated
     index = program_status[random_index]
 
-    return_value = ""
     # get index to next number
     rand_number = random_number[index]
 
@@ -275,13 +617,13 @@ def process_rand_number(rand_number_str):
     if rand_number_str.startswith("-"):
         rand_number *= -1
 
-    return_value = str(append_stack(rand_number))
+    return_value = append_stack(rand_number, stack)
 
     # if apppend has been successful increment random number index
-    if return_value == "":
+    if return_value == no_error:
         index += 1
-        # reset to 0 if beyond stack limit
-        if index > stack_limit:
+        # reset to 0 if beyond end of random number list
+        if index >= len(random_number):
             index = 0
         # save incremented index
         program_status[random_index] = index
@@ -289,59 +631,94 @@ def process_rand_number(rand_number_str):
     return return_value
 
 
-def process_arithmetic_operator(operator):
+def process_power(x, y):
     """
-    <operator> = valid arithmetic operators: +, -, /, *, ^, %
+    <x> float = base, <y> float = exponent (>= 1)
 
-    Pops the last two values off the stack[x, y] and
-    pushes result of the corresponding operation onto the stack[]
-    after checking for zero divide and saturation.   Maintains float
-    values for calculation accuracy
+    Raises <x> to the power <y>, saturating results too large to
+    hold as a float. A negative base with a fractional exponent uses
+    the integer part of the exponent, as the integer SRPN would
 
-    Returns: <string> empty or contains "Error message"
+    Returns: <number>
     """
+    # python would return a complex number here, which cannot be
+    # saturated or displayed, so drop the fraction of the exponent
+    if x < 0 and not y.is_integer():
+        y = float(int(y))
+
     try:
-        return_value = ""
-        x = 0  # first operand
-        y = 0  # second operand
+        return x ** y
+    except OverflowError:
+        # only reachable when |x| > 1, sign follows an odd exponent
+        if x < 0 and y % 2 == 1:
+            return min_nr
+        return max_nr
+
+
+def calculate_operator(operator, x, y):
+    """
+    Args:
+    <operator> = valid arithmetic operators: +, -, /, *, ^, %
+    <x> float = first operand, <y> float = second operand
+
+    Performs the operation on <x> and <y>, the caller has already checked
+    for zero divide and negative power
+
+    Returns: <number> saturated result
+    """
+    if operator == "+":
+        return check_saturation(x + y)
+
+    if operator == "-":
+        return check_saturation(x - y)
+
+    if operator == "*":
+        return check_saturation(x * y)
+
+    if operator == "/":
+        return check_saturation(x / y)
 
-        # exit with error message if less than 2
-        # numbers on the stack
-        if len(stack) < 2:
-            return stack_underflow_msg
-        # check for divide by zero error first
-        if operator in ["/", "%"] and float(stack[-1]) == 0:
-            return zero_divide_msg
-        # only if y is positive do we perform calculation
-        if operator == "^" and float(stack[-1]) < 1:
-            return negative_power_msg
+    if operator == "^":
+        return check_saturation(process_power(x, y))
 
-        # perform calculations on last two numbers on stack
-        y = float(stack.pop())
-        x = float(stack.pop())
+    # operator == "%"
+    return check_saturation(x % y)
 
-        if operator == "+":
-            append_stack(check_saturation(x + y))
 
-        elif operator == "-":
-            append_stack(check_saturation(x - y))
+def process_arithmetic_operator(operator, stack):
+    """
+    <operator> = valid arithmetic operators: +, -, /, *, ^, %
+    <stack> = session stack list
 
-        elif operator == "*":
-            append_stack(check_saturation(x * y))
+    Pops the last two values off the stack[x, y] and
+    pushes result of the corresponding operation onto the stack[]
+    after checking for zero divide and saturation.   Maintains float
+    values for calculation accuracy
 
-        elif operator == "/":
-            append_stack(check_saturation(x / y))
+    Returns: <int> error code, no_error or the error found
+    """
+    x = 0  # first operand
+    y = 0  # second operand
 
-        elif operator == "^":
-            append_stack(check_saturation(x ** y))
+    # exit with error code if less than 2
+    # numbers on the stack
+    if len(stack) < 2:
+        return stack_underflow_error
+    # check for divide by zero error first
+    if operator in ["/", "%"] and float(stack[-1]) == 0:
+        return zero_divide_error
+    # only if y is positive do we perform calculation
+    if operator == "^" and float(stack[-1]) < 1:
+        return negative_power_error
 
-        elif operator == "%":
-            append_stack(check_saturation(x % y))
+    # perform calculations on last two numbers on stack
+    y = float(stack.pop())
+    x = float(stack.pop())
 
-        return return_value
+    # popping two values means the push can never overflow
+    stack.append(calculate_operator(operator, x, y))
 
-    except ZeroDivisionError:
-        return zero_divide_msg
+    return no_error
 
 
 def op_precedence_change(current_op, previous_op):
@@ -603,14 +980,10 @@ def parse_number(command, command_index):
             # position at next char after r
             increment += 1
         else:
-            # loop until end of digits
-            while i != -1:
-                if command[i : i + 1].isdigit() is True:
-                    number_string += command[i : i + 1]
-                    increment += 1
-                    i += 1
-                else:
-                    i = -1
+            # match up to the end of the digits in one step
+            digits = decimal_digits_pattern.match(command, i).group()
+            number_string += digits
+            increment += len(digits)
 
     if number_string == "":
         # arriving here means no number found so set index to -1
@@ -633,9 +1006,11 @@ def parse_number(command, command_index):
     return command_index, number_string
 
 
-def parse_command_line(command):
+def parse_command_line(command, program_status):
     """
     <command> = STR value containing input command(s)
+    <program_status> = session program status list, holds the multiline
+    comment state carried between commands
 
     Performs lexical analysis of <command> string returning list of operators
     and operands.  Operators are defined as any single character, with no
@@ -663,154 +1038,372 @@ def parse_command_line(command):
     arithmetic_op_buffer = []
     increment = 0
 
-    try:
-        # if <comment_string> not empty then add \\n character to
-        # display comment over multiple lines
-        if comment_string:
-            comment_string += "\\n"
-
-        # loop through each character in command string
-        # and build rpn tokens.Starting -1 allows end of command
-        # string to be actioned before exiting while loop
-        i = -1
-        while i <= len(command) - 1:
-            # move to and extract into s the next character
-            i += 1
-            s = command[i : i + 1]
-
-            #       Parse Comment delimiter
-            #       -----------------------
-            #   *** THIS TEST MUST GO FIRST in parsing sequence to
-            #       avoid operators and operands inside comment strings
-            #       spanning multiple command lines being parsed !
-
-            # test to see if comment or possible comment when s is not empty
-            # but always parse text if already inside a delimited comment
-            # or outside and s is the comment operator
-
-            if s and (
-                comment_flag is True
-                or (
-                    comment_flag is False
-                    and command[i : i + len(comment_operator)]
-                    == comment_operator
-                )
-            ):
+    # if <comment_string> not empty then add \\n character to
+    # display comment over multiple lines
+    if comment_string:
+        comment_string += "\\n"
+
+    # loop through each character in command string
+    # and build rpn tokens.Starting -1 allows end of command
+    # string to be actioned before exiting while loop
+    i = -1
+    while i <= len(command) - 1:
+        # move to and extract into s the next character
+        i += 1
+        s = command[i : i + 1]
+
+        #       Parse Comment delimiter
+        #       -----------------------
+        #   *** THIS TEST MUST GO FIRST in parsing sequence to
+        #       avoid operators and operands inside comment strings
+        #       spanning multiple command lines being parsed !
+
+        # test to see if comment or possible comment when s is not empty
+        # but always parse text if already inside a delimited comment
+        # or outside and s is the comment operator
+
+        if s and (
+            comment_flag is True
+            or (
+                comment_flag is False
+                and command[i : i + len(comment_operator)]
+                == comment_operator
+            )
+        ):
 
-                # check for comment strings delimited by " # " - with no
-                # leading/trailing space if this occurs at the start/end
-                # of the <command>
-                comment_flag, increment, comment_string = parse_comment(
-                    command, i, comment_flag, comment_string
-                )
-                # check if comment found ie <increment> > 0
-                # and move current command character index forward by
-                # increment
-                if increment > 0:
-                    i = increment
-                    # check if end of comment found and append to rpn tokens
-                    if comment_flag is False:
-                        command_tokens.append(comment_string)
-                        # reinitialise comment_string variable
-                        comment_string = ""
-                else:
-                    # arrive here then comment token not passing delimiter
-                    # tests so add to <rpn_tokens>
-                    command_tokens += arithmetic_op_buffer[::-1]
-                    arithmetic_op_buffer = []
-                    command_tokens.append(s)
-
-            #       Flush arithmetic_op_buffer when space or end of line
-            #       or preceeding op of higher and this one was lower
-            #       ----------------------------------------------------
-            elif s.isspace() is True or not s:
-                # if <arithmetic_op_buffer> not empty then appended to
-                # rpn token list in reversed in order
-                if arithmetic_op_buffer:
-                    command_tokens += arithmetic_op_buffer[::-1]
+            # check for comment strings delimited by " # " - with no
+            # leading/trailing space if this occurs at the start/end
+            # of the <command>
+            comment_flag, increment, comment_string = parse_comment(
+                command, i, comment_flag, comment_string
+            )
+            # check if comment found ie <increment> > 0
+            # and move current command character index forward by
+            # increment
+            if increment > 0:
+                i = increment
+                # check if end of comment found and append to rpn tokens
+                if comment_flag is False:
+                    command_tokens.append(comment_string)
+                    # reinitialise comment_string variable
+                    comment_string = ""
+            else:
+                # arrive here then comment token not passing delimiter
+                # tests so add to <rpn_tokens>
+                command_tokens += arithmetic_op_buffer[::-1]
                 arithmetic_op_buffer = []
+                command_tokens.append(s)
 
-                # ignore the space character and skip to next in command
-                # continue
-
-            #       Parse number strings
-            #       --------------------
-
-            # test to see if number when s is not empty or a space character
-            # and is a digit or possible digit then get number string
-            elif (s or s.isspace()) and (
-                (s in valid_number_digits)
-                or (
-                    s == "-"
-                    and (
-                        (command[i + 1 : i + 2] in valid_number_digits)
-                        or (command[i - 1 : i] not in valid_number_digits)
-                    )
+        #       Flush arithmetic_op_buffer when space or end of line
+        #       or preceeding op of higher and this one was lower
+        #       ----------------------------------------------------
+        elif s.isspace() is True or not s:
+            # if <arithmetic_op_buffer> not empty then appended to
+            # rpn token list in reversed in order
+            if arithmetic_op_buffer:
+                command_tokens += arithmetic_op_buffer[::-1]
+            arithmetic_op_buffer = []
+
+            # ignore the space character and skip to next in command
+            # continue
+
+        #       Parse number strings
+        #       --------------------
+
+        # test to see if number when s is not empty or a space character
+        # and is a digit or possible digit then get number string
+        elif (s or s.isspace()) and (
+            (s in valid_number_digits)
+            or (
+                s == "-"
+                and (
+                    (command[i + 1 : i + 2] in valid_number_digits)
+                    or (command[i - 1 : i] not in valid_number_digits)
                 )
+            )
+        ):
+            increment, number_string = parse_number(command, i)
+
+            # if number found ie <increment> => 0 (nb 0 is the first
+            # char position) then move current command character index
+            # forward by increment
+            if increment >= 0:
+                i = increment
+                # append number to rpn to token
+                command_tokens.append(number_string)
+                # continue
+            else:
+                # not a number so add char to token list
+                arithmetic_op_buffer.append(s)
+
+        #       Parse 'compact' arithmetic expressions
+        #       --------------------------------------
+        # where no spaces between operators and operands,
+        # e.g. sequences like: 1+1=+2, or ++1-2= or 1+=
+
+        elif s in arithmetic_operators:
+            # get the previous operator or use lowest arithmetic
+            # operator as default
+            last_op = ""
+            if len(arithmetic_op_buffer) == 0:
+                last_op = "+"
+            else:
+                last_op = arithmetic_op_buffer[-1]
+
+            # test for next char being space or end of line or
+            # an op with lower arithmetic procedence
+            if (
+                command[i + 1 : i + 2].isspace()
+                or len(command[i + 1 : i + 2]) == 0
+                or op_precedence_change(s, last_op)
             ):
-                increment, number_string = parse_number(command, i)
-
-                # if number found ie <increment> => 0 (nb 0 is the first
-                # char position) then move current command character index
-                # forward by increment
-                if increment >= 0:
-                    i = increment
-                    # append number to rpn to token
-                    command_tokens.append(number_string)
-                    # continue
-                else:
-                    # not a number so add char to token list
-                    arithmetic_op_buffer.append(s)
-
-            #       Parse 'compact' arithmetic expressions
-            #       --------------------------------------
-            # where no spaces between operators and operands,
-            # e.g. sequences like: 1+1=+2, or ++1-2= or 1+=
-
-            elif s in arithmetic_operators:
-                # get the previous operator or use lowest arithmetic
-                # operator as default
-                last_op = ""
-                if len(arithmetic_op_buffer) == 0:
-                    last_op = "+"
-                else:
-                    last_op = arithmetic_op_buffer[-1]
-
-                # test for next char being space or end of line or
-                # an op with lower arithmetic procedence
-                if (
-                    command[i + 1 : i + 2].isspace()
-                    or len(command[i + 1 : i + 2]) == 0
-                    or op_precedence_change(s, last_op)
-                ):
-                    # if any above true then flush the buffer
-                    command_tokens += arithmetic_op_buffer[::-1]
-                    arithmetic_op_buffer = []
-                    arithmetic_op_buffer.append(s)
-                else:
-                    # append current op to buffer
-                    arithmetic_op_buffer.append(s)
+                # if any above true then flush the buffer
+                command_tokens += arithmetic_op_buffer[::-1]
+                arithmetic_op_buffer = []
+                arithmetic_op_buffer.append(s)
+            else:
+                # append current op to buffer
+                arithmetic_op_buffer.append(s)
 
-                # continue
+            # continue
 
-            #       Non space character (not in above tests)
-            #       ----------------------------------------
-            elif s.isspace() is not True:
-                # append non space character in s to rpn_tokens list
-                command_tokens.append(s)
+        #       Non space character (not in above tests)
+        #       ----------------------------------------
+        elif s.isspace() is not True:
+            # append non space character in s to rpn_tokens list
+            command_tokens.append(s)
+
+    # after parsing command elements pass back
+    # to caller tokenized input command string and update
+    # program status settings
+    program_status[multiline_comment_flag] = comment_flag
+    program_status[previous_comment_string] = comment_string
+    return command_tokens
+
+
+def stack_effect(rpn_elements):
+    """
+    <rpn_elements> = token list from parse_command_line()
+
+    Static analysis of the change in stack depth caused by <rpn_elements>.
+    A '/', '%' or '^' which fails on a zero divide or negative power
+    leaves the stack unchanged, so depths are tracked as a low/high range.
+
+    Returns:
+        <required_depth> (int) = least starting depth with no stack
+        underflow or stack empty error,
+        <max_growth> (int)     = most the depth can rise above the start,
+        <net_low> (int), <net_high> (int) = range of the net depth change
+    """
+    required_depth = 0
+    max_growth = 0
+    low = 0
+    high = 0
+
+    for s in rpn_elements:
+        if s in arithmetic_operators:
+            required_depth = max(required_depth, 2 - low)
+            low -= 1
+            if s not in ["/", "%", "^"]:
+                high -= 1
+
+        elif (
+            s.startswith(number_token) is True
+            or s.startswith(rand_number_token) is True
+            or (
+                s.startswith(octal_number_token) is True
+                # illegal Octal values are ignored
+                and "8" not in s
+                and "9" not in s
+            )
+        ):
+            low += 1
+            high += 1
+            max_growth = max(max_growth, high)
+
+        elif s == equals_operator:
+            required_depth = max(required_depth, 1 - low)
+
+    return required_depth, max_growth, low, high
+
+
+def render_events(output_events):
+    """
+    <output_events> = list of (code, payload) output events
+
+    Converts output events into display text, each value or message
+    trailed by '\\n'. Values are converted to INT to format correctly
+    on output
+
+    Returns: <string> containing concatented list of display outputs
+    """
+    output_lines = []
+
+    for code, payload in output_events:
+        if code == value_event:
+            output_lines.append(str(int(float(payload))) + "\n")
+        elif code == unrecognised_op_error:
+            output_lines.append(unrecognised_op_msg.format(payload))
+        else:
+            output_lines.append(error_messages[code])
+
+    return "".join(output_lines)
+
+
+def process_tokens(rpn_elements, session, output_events):
+    """
+    Args:
+    <rpn_elements> = token list from parse_command_line()
+    <session> = session list from new_session()
+    <output_events> = list of (code, payload) output events
+
+    Actions each operator and operand token in turn on <session>,
+    appending any displayed values and errors to <output_events>
+
+    When stack_effect() shows the current stack depth can neither
+    overflow nor underflow the tokens are run by
+    process_tokens_unchecked(), otherwise by process_tokens_checked()
+
+    Returns: <list> <output_events>
+    """
+    stack = session[session_stack]
+
+    required_depth, max_growth, _, _ = stack_effect(rpn_elements)
+    if required_depth <= len(stack) <= stack_limit - max_growth:
+        return process_tokens_unchecked(rpn_elements, session, output_events)
+
+    return process_tokens_checked(rpn_elements, session, output_events)
+
+
+def process_tokens_checked(rpn_elements, session, output_events):
+    """
+    Args:
+    <rpn_elements> = token list from parse_command_line()
+    <session> = session list from new_session()
+    <output_events> = list of (code, payload) output events
+
+    Actions each token as process_tokens() checking the stack depth for
+    every push and operator
+
+    Returns: <list> <output_events>
+    """
+    stack = session[session_stack]
+    program_status = session[session_status]
+    error_code = no_error
+
+    for s in rpn_elements:
+
+        #       Comment handling
+        #       ----------------
+        # ignore comment tokens
+        if s.startswith(comment_token) is True:
+            continue
+
+        #       Process Arithmetic operators
+        #       ----------------------------
+        if s in arithmetic_operators:  # ["+", "-", "*", "/", "^", "%"]:
+            error_code = process_arithmetic_operator(s, stack)
+
+        #       Process numbers
+        #       ---------------
+        # if number formats like 0o11, 0b0101 or 0xAA were permitted
+        # the is_int_str def would need modifying to recognise these
+        elif s.startswith(number_token) is True:
+            error_code = process_number(s[len(number_token) :], stack)
+
+        #       Process random number
+        #       ---------------------
+        # deals with random number
+        elif s.startswith(rand_number_token) is True:
+            error_code = process_rand_number(
+                s[len(rand_number_token) :], stack, program_status
+            )
+
+        #       Process Octal numbers
+        #       ---------------------
+
+        elif s.startswith(octal_number_token) is True:
+            error_code = process_octal_number(
+                s[len(octal_number_token) :], stack
+            )
+
+        #       Process Equals show last result operator
+        #       ----------------------------------------
+        # perform = which displays last number appended to the stack
+        elif s == equals_operator:
+            error_code = process_equals(stack, output_events)
+
+        #       Process "d" display stack operator
+        #       ----------------------------------
+        # special instruction d (must be lower case) = display stack
+        elif s == display_stack_operator:
+            error_code = display_stack(stack, output_events)
+
+        # if you reach here then it must be an illegal operator
+        else:
+            output_events.append((unrecognised_op_error, s))
+            continue
+
+        if error_code != no_error:
+            output_events.append((error_code, None))
+
+    return output_events
+
+
+def process_tokens_unchecked(rpn_elements, session, output_events):
+    """
+    Args:
+    <rpn_elements> = token list from parse_command_line()
+    <session> = session list from new_session()
+    <output_events> = list of (code, payload) output events
+
+    Fast path of process_tokens() used only when stack_effect() proves
+    no push can overflow and no operator can underflow the stack from
+    its current depth, so those checks are skipped. Zero divide and
+    negative power still depend on the values and are checked
 
-        # after parsing command elements pass back
-        # to caller tokenized input command string and update
-        # program status settings
-        program_status[multiline_comment_flag] = comment_flag
-        program_status[previous_comment_string] = comment_string
-        return command_tokens
+    Returns: <list> <output_events>
+    """
+    stack = session[session_stack]
+
+    for s in rpn_elements:
+        if s.startswith(comment_token) is True:
+            continue
+
+        if s in arithmetic_operators:
+            if s in ["/", "%"] and float(stack[-1]) == 0:
+                output_events.append((zero_divide_error, None))
+            elif s == "^" and float(stack[-1]) < 1:
+                output_events.append((negative_power_error, None))
+            else:
+                y = float(stack.pop())
+                x = float(stack.pop())
+                stack.append(calculate_operator(s, x, y))
+
+        elif s.startswith(number_token) is True:
+            stack.append(convert_number(s[len(number_token) :]))
+
+        elif s.startswith(rand_number_token) is True:
+            process_rand_number(
+                s[len(rand_number_token) :], stack, session[session_status]
+            )
+
+        elif s.startswith(octal_number_token) is True:
+            process_octal_number(s[len(octal_number_token) :], stack)
+
+        elif s == equals_operator:
+            output_events.append((value_event, stack[-1]))
+
+        elif s == display_stack_operator:
+            display_stack(stack, output_events)
 
-    except:
-        return ""
+        else:
+            output_events.append((unrecognised_op_error, s))
+
+    return output_events
 
 
-def process_command(command):
+def process_command(command, session=None):
     """
      Saturated Reverse Polish Notation Calculator (RPNC)
      Implements a simple integer arithmetic calculator.
@@ -843,96 +1436,1660 @@ def process_command(command):
     0123 converts to 85 decimal (base 10) but from Python v3 must first be
     reformated as 0o123 to avoid syntax error
 
+    <session> = session list from new_session(), default_session if None.
+    All calculator state is read from and written to <session> only, so
+    different sessions may be actioned from different threads at the
+    same time. One session must not be used by two threads at once,
+    submit_command() and map_commands() guarantee this for executor jobs
+
     Returns: <string> containing concatented list of display outputs
     """
+    if session is None:
+        session = default_session
+
+    if session[session_budget] is not None:
+        return process_command_governed(command, session)
 
-    # define local def variables
-    rpn_elements = []
-    temp_element = []
-    # buffer to hold all outputs generated from input command in
+    # list of (code, payload) events generated from input command in
     # the FIFO sequence they are generated
-    output_buffer = ""
+    output_events = []
 
-    try:
+    # parse the command line into operator and operands stream
+    rpn_elements = parse_command_line(command, session[session_status])
 
-        # parse the command line into operator and operands stream
-        temp_element = parse_command_line(command)
-        if len(temp_element) > 0:
-            rpn_elements += temp_element
+    # action operator and operands
+    process_tokens(rpn_elements, session, output_events)
 
-        # action operator and operands
+    # return outputs as concatented string, stripping last trailing \n
+    return render_events(output_events)[:-1]
 
-        for s in rpn_elements:
 
-            #       Comment handling
-            #       ----------------
-            # ignore comment tokens
-            if s.startswith(comment_token) is True:
-                continue
+def govern_command(command, session, output_events):
+    """
+    Args:
+    <command> = STR value containing input command(s)
+    <session> = session list with a resource budget
+    <output_events> = list of (code, payload) output events
 
-            #       Process Arithmetic operators
-            #       ----------------------------
-            if s in arithmetic_operators:  # ["+", "-", "*", "/", "^", "%"]:
-                output_buffer += process_arithmetic_operator(s)
-                continue
+    Parses and actions <command> on <session> enforcing the session
+    budget. A command over a line length, token or session limit is not
+    actioned and leaves the session unchanged, a command
+    running over an operation or time limit stops at that point. Either
+    way a budget exceeded error is output. The time limits are checked
+    every budget_check_interval tokens so a single token may run over
 
-            #       Process numbers
-            #       ---------------
-            # if number formats like 0o11, 0b0101 or 0xAA were permitted
-            # the is_int_str def would need modifying to recognise these
-            if s.startswith(number_token) is True:
-                output_buffer += process_number(s[len(number_token) :])
-                continue
+    Returns: <list> <output_events>
+    """
+    budget = session[session_budget]
+    usage = session[session_usage]
+    program_status = session[session_status]
+
+    # operations and seconds left for this command, None if no limit
+    operations_left = budget[budget_operations]
+    if budget[budget_session_operations] is not None:
+        session_operations_left = budget[budget_session_operations] - usage[0]
+        if (
+            operations_left is None
+            or session_operations_left < operations_left
+        ):
+            operations_left = session_operations_left
 
-            #       Process random number
-            #       ---------------------
-            # deals with random number
-            if s.startswith(rand_number_token) is True:
-                output_buffer += process_rand_number(
-                    s[len(rand_number_token) :]
-                )
-                continue
+    seconds_left = budget[budget_line_seconds]
+    if budget[budget_session_seconds] is not None:
+        session_seconds_left = budget[budget_session_seconds] - usage[1]
+        if seconds_left is None or session_seconds_left < seconds_left:
+            seconds_left = session_seconds_left
 
-            #       Process Octal numbers
-            #       ---------------------
+    if (
+        (
+            budget[budget_line_length] is not None
+            and len(command) > budget[budget_line_length]
+        )
+        or (operations_left is not None and operations_left <= 0)
+        or (seconds_left is not None and seconds_left <= 0)
+    ):
+        output_events.append((budget_exceeded_error, None))
+        return output_events
 
-            if s.startswith(octal_number_token) is True:
-                output_buffer += process_octal_number(
-                    s[len(octal_number_token) :]
-                )
-                continue
+    # parse with a copy of the status settings so a command over the
+    # token limit does not change the multiline comment state
+    command_status = list(program_status)
+    rpn_elements = parse_command_line(command, command_status)
 
-            #       Process Equals show last result operator
-            #       ----------------------------------------
-            # perform = which displays last number appended to the stack ****
-            if s == "=":
-                output_buffer += process_equals()
-                continue
+    if (
+        budget[budget_tokens] is not None
+        and len(rpn_elements) > budget[budget_tokens]
+    ):
+        output_events.append((budget_exceeded_error, None))
+        return output_events
+
+    program_status[multiline_comment_flag] = command_status[
+        multiline_comment_flag
+    ]
+    # drop unclosed comment text beyond the limit, it is never displayed
+    program_status[previous_comment_string] = command_status[
+        previous_comment_string
+    ][: budget[budget_comment_length]]
+
+    budget_exceeded = False
+    if operations_left is not None and len(rpn_elements) > operations_left:
+        rpn_elements = rpn_elements[:operations_left]
+        budget_exceeded = True
+
+    start_time = perf_counter()
+    operations = 0
+
+    # action the tokens in slices so the time can be checked between them
+    while operations < len(rpn_elements):
+        process_tokens(
+            rpn_elements[operations : operations + budget_check_interval],
+            session,
+            output_events,
+        )
+        operations += budget_check_interval
+
+        if (
+            seconds_left is not None
+            and operations < len(rpn_elements)
+            and perf_counter() - start_time > seconds_left
+        ):
+            budget_exceeded = True
+            break
 
-            #       Process "r" generate psuedo rand number operator
-            #       ------------------------------------------------
-            # perform = which displays last number appended to the stack
-            if s.startswith(rand_number_token) is True:
+    usage[0] += min(operations, len(rpn_elements))
+    usage[1] += perf_counter() - start_time
 
-                output_buffer += process_rand_number(s[len(number_token) :])
-                continue
+    if budget_exceeded:
+        output_events.append((budget_exceeded_error, None))
 
-            #       Process "d" display stack operator
-            #       ----------------------------------
-            # special instruction d (must be lower case) = display stack
-            if s == "d":
-                output_buffer += display_stack()
-                continue
+    return output_events
+
+
+def process_command_governed(command, session):
+    """
+    Args:
+    <command> = STR value containing input command(s)
+    <session> = session list with a resource budget
+
+    As process_command() but enforcing the session budget, see
+    govern_command()
+
+    Returns: <string> containing concatented list of display outputs
+    """
+    output_events = govern_command(command, session, [])
+
+    # return outputs as concatented string, stripping last trailing \n
+    return render_events(output_events)[:-1]
+
+
+def snapshot_session(session):
+    """
+    <session> = session list from new_session()
+
+    Takes an immutable copy of the calculator state of <session>. The
+    stack never holds more than stack_limit values so this is a fixed
+    small cost, and snapshots can be shared freely between sessions
+
+    Returns: <snapshot> tuple (stack values, random index,
+    multiline comment flag, comment string)
+    """
+    program_status = session[session_status]
+
+    return (
+        tuple(session[session_stack]),
+        program_status[random_index],
+        program_status[multiline_comment_flag],
+        program_status[previous_comment_string],
+    )
+
+
+def restore_session(session, snapshot):
+    """
+    Args:
+    <session> = session list from new_session()
+    <snapshot> = tuple from snapshot_session()
+
+    Sets the calculator state of <session> back to <snapshot>. The
+    stack list is updated in place so references to it stay valid
+    """
+    program_status = session[session_status]
+
+    session[session_stack][:] = snapshot[0]
+    program_status[random_index] = snapshot[1]
+    program_status[multiline_comment_flag] = snapshot[2]
+    program_status[previous_comment_string] = snapshot[3]
 
-            # if you reach here then it must be an illegal operator
-            output_buffer += unrecognised_op_msg.replace("%", s)
 
-        # return outputs as concatented string, stripping last trailing \n
-        return output_buffer[:-1]
+def process_command_with_history(command, session=None):
+    """
+    Args:
+    <command> = STR value containing input command(s)
+    <session> = session list from new_session(), default_session if None
+
+    As process_command() but first records the session state in the
+    session history so the command can be reverted by undo_command()
+
+    Returns: <string> containing concatented list of display outputs
+    """
+    if session is None:
+        session = default_session
+
+    session[session_history] = (
+        snapshot_session(session),
+        session[session_history],
+    )
+
+    return process_command(command, session)
+
+
+def undo_command(session=None):
+    """
+    <session> = session list from new_session(), default_session if None
+
+    Reverts <session> to its state before the last command actioned by
+    process_command_with_history()
+
+    Returns: <bool> True if a command was undone, False if no history
+    """
+    if session is None:
+        session = default_session
+
+    history = session[session_history]
+    if history is None:
+        return False
+
+    restore_session(session, history[0])
+    session[session_history] = history[1]
+
+    return True
+
+
+def branch_session(session=None):
+    """
+    <session> = session list from new_session(), default_session if None
+
+    Creates a new session with the same calculator state as <session>.
+    The undo history is shared, not copied, so the branch can undo back
+    past the point it was made without affecting <session>. The branch
+    has the same resource budget and starts from the resources already
+    used by <session>
+
+    Returns: <session> list [stack, program_status, lock, history,
+    budget, usage]
+    """
+    if session is None:
+        session = default_session
+
+    branch = new_session(session[session_budget])
+    restore_session(branch, snapshot_session(session))
+    branch[session_history] = session[session_history]
+    # the branch carries on from the resources the session already used
+    branch[session_usage] = list(session[session_usage])
+
+    return branch
+
+
+def process_command_speculative(command, session=None):
+    """
+    Args:
+    <command> = STR value containing input command(s)
+    <session> = session list from new_session(), default_session if None
+
+    Actions <command> on <session> and rolls the session back to its
+    previous state if any error was output. A session budget is applied
+    as by process_command() and exceeding it also rolls back
+
+    Returns:
+        <output> (str)     = display outputs as from process_command(),
+        <committed> (bool) = False if the command was rolled back
+    """
+    if session is None:
+        session = default_session
+
+    snapshot = snapshot_session(session)
+
+    if session[session_budget] is not None:
+        output_events = govern_command(command, session, [])
+    else:
+        output_events = process_tokens(
+            parse_command_line(command, session[session_status]),
+            session,
+            [],
+        )
+
+    committed = True
+    for code, _ in output_events:
+        if code != value_event:
+            restore_session(session, snapshot)
+            committed = False
+            break
+
+    # return outputs as concatented string, stripping last trailing \n
+    return render_events(output_events)[:-1], committed
+
+
+def new_session_store(capacity):
+    """
+    <capacity> (int) = number of session slots, numbered 0 to capacity-1
+
+    Creates a session store with every slot holding an empty stack and
+    default program status settings. Each slot takes stack_limit doubles
+    and three bytes, an open multiline comment also keeps its string
+
+    Returns: <store> list [values, depths, random indexes, comment flags,
+    comment strings]
+    """
+    return [
+        array("d", [0.0]) * (capacity * stack_limit),
+        array("B", [0]) * capacity,
+        array("B", [0]) * capacity,
+        array("B", [0]) * capacity,
+        {},
+    ]
+
+
+def load_session(store, slot, session):
+    """
+    Args:
+    <store> = session store from new_session_store()
+    <slot> (int) = session slot number
+    <session> = session list to load the slot state into
+
+    Copies the state of <slot> into <session> so it can be actioned by
+    the calculator defs. The stack is at most stack_limit values
+    """
+    start = slot * stack_limit
+    program_status = session[session_status]
+
+    session[session_stack][:] = store[store_values][
+        start : start + store[store_depths][slot]
+    ]
+    program_status[random_index] = store[store_random_indexes][slot]
+    program_status[multiline_comment_flag] = (
+        store[store_comment_flags][slot] == 1
+    )
+    program_status[previous_comment_string] = store[
+        store_comment_strings
+    ].get(slot, "")
+
+
+def save_session(store, slot, session):
+    """
+    Args:
+    <store> = session store from new_session_store()
+    <slot> (int) = session slot number
+    <session> = session list holding the state to save
+
+    Copies the state of <session> back into <slot>
+    """
+    start = slot * stack_limit
+    stack = session[session_stack]
+    program_status = session[session_status]
+
+    store[store_values][start : start + len(stack)] = array("d", stack)
+    store[store_depths][slot] = len(stack)
+    store[store_random_indexes][slot] = program_status[random_index]
+
+    if program_status[multiline_comment_flag] is True:
+        store[store_comment_flags][slot] = 1
+        store[store_comment_strings][slot] = program_status[
+            previous_comment_string
+        ]
+    else:
+        store[store_comment_flags][slot] = 0
+        store[store_comment_strings].pop(slot, None)
+
+
+def process_store_command(store, slot, command, session=None):
+    """
+    Args:
+    <store> = session store from new_session_store()
+    <slot> (int) = session slot number
+    <command> = STR value containing input command(s)
+    <session> = work session reused between calls, new if None
+
+    Actions <command> on the session held in <slot> by loading it into
+    <session>, running process_command() and saving it back. A store is
+    not thread safe, use one store, or one lock around it, per thread
 
-    except:
-        # return outputs as concatented string, stripping last trailing \n
-        return output_buffer[:-1]
+    Returns: <string> containing concatented list of display outputs
+    """
+    if session is None:
+        session = new_session()
+
+    load_session(store, slot, session)
+    output = process_command(command, session)
+    save_session(store, slot, session)
+
+    return output
+
+
+def iter_tokens(lines, program_status=None):
+    """
+    Args:
+    <lines> = iterable of input command strings, a trailing end of line
+    is removed so file objects can be passed directly
+    <program_status> = program status list holding the multiline comment
+    state, a new one is used if None. Pass session[session_status] to
+    share the comment state with a session
+
+    Lazily parses each line with parse_command_line()
+
+    Yields: token List[] for each line
+    """
+    if program_status is None:
+        program_status = [0, False, ""]
+
+    for line in lines:
+        yield parse_command_line(line.rstrip("\r\n"), program_status)
+
+
+def scan_comment_state(lines, comment_flag, comment_string):
+    """
+    Args:
+    <lines> = list of input command strings
+    <comment_flag> (bool) = True if <lines> start inside a comment
+    <comment_string> (str) = unclosed comment string before <lines>
+
+    First phase of parallel lexing. Finds the multiline comment status
+    after <lines> without tokenizing them. Only the comment delimiters
+    are located, following the rules of parse_comment(), and the open
+    comment string is built from the lines it spans once at the end
+
+    Returns:
+        <comment_flag> (bool),
+        <comment_string> (str)
+    """
+    # pieces of the unclosed comment string, joined only when needed
+    comment_pieces = [comment_string] if comment_string else []
+    comment_start = comment_token + comment_operator + " "
+    delimiter = " " + comment_operator + " "
+
+    for line in lines:
+        # parse_command_line() starts each line of a comment on a new line
+        if comment_pieces:
+            comment_pieces.append("\\n")
+
+        if comment_operator not in line:
+            if comment_flag is True:
+                comment_pieces.append(line)
+            continue
+
+        # walk the delimiters on <line>, <index> is the next character
+        # the parser would look at
+        index = 0
+        while index < len(line):
+            if comment_flag is True:
+                # closing delimiter at the start, mid line or end of line
+                if index == 0 and (
+                    line == comment_operator
+                    or line.startswith(comment_operator + " ")
+                ):
+                    index = len(comment_operator) + 1
+                else:
+                    i = line.find(delimiter, index)
+                    if i > 0:
+                        index = i + len(delimiter)
+                    elif line.endswith(" " + comment_operator) is True:
+                        index = len(line)
+                    else:
+                        # comment stays open past the end of <line>
+                        comment_pieces.append(line[index:])
+                        break
+                comment_flag = False
+                comment_pieces = []
+                continue
+
+            # opening delimiter at the start or mid line, any other
+            # comment operator is parsed as an operator
+            i = line.find(comment_operator, index)
+            if i < 0:
+                break
+            if (
+                i == 0
+                and (
+                    line == comment_operator
+                    or line.startswith(comment_operator + " ")
+                )
+            ) or line[i - 1 : i + 2] == delimiter:
+                comment_flag = True
+                comment_pieces = [comment_start]
+                index = i + len(comment_operator) + 1
+            else:
+                index = i + len(comment_operator)
+
+    return comment_flag, "".join(comment_pieces)
+
+
+def tokenize_chunk(lines, comment_flag, comment_string):
+    """
+    Args:
+    <lines> = list of input command strings
+    <comment_flag> (bool) = True if <lines> start inside a comment
+    <comment_string> (str) = unclosed comment string before <lines>
+
+    Second phase of parallel lexing, run in a worker process. Parses
+    <lines> from the comment status found by scan_comment_state()
+
+    Returns: List[] of token lists, one per line
+    """
+    command_status = [0, comment_flag, comment_string]
+    return [parse_command_line(line, command_status) for line in lines]
+
+
+def iter_tokens_parallel(
+    lines, executor, program_status=None, chunk_size=4096, max_pending=16
+):
+    """
+    Args:
+    <lines> = iterable of input command strings, a trailing end of line
+    is removed so file objects can be passed directly
+    <executor> = concurrent.futures executor, e.g. ProcessPoolExecutor
+    <program_status> = program status list holding the multiline comment
+    state, a new one is used if None. It is updated once all lines have
+    been yielded
+    <chunk_size> (int) = lines tokenized by each executor job
+    <max_pending> (int) = most chunks submitted but not yet yielded
+
+    As iter_tokens() but parsing chunks of <lines> in parallel. Each
+    chunk is scanned by scan_comment_state() for the comment status at
+    the start of the next chunk, then tokenized on <executor> by
+    tokenize_chunk(). Results are yielded in the order of <lines>
+
+    Yields: token List[] for each line
+    """
+    if program_status is None:
+        program_status = [0, False, ""]
+
+    comment_flag = program_status[multiline_comment_flag]
+    comment_string = program_status[previous_comment_string]
+    pending = deque()
+    chunk = []
+
+    for line in lines:
+        chunk.append(line.rstrip("\r\n"))
+        if len(chunk) < chunk_size:
+            continue
+
+        pending.append(
+            executor.submit(
+                tokenize_chunk, chunk, comment_flag, comment_string
+            )
+        )
+        comment_flag, comment_string = scan_comment_state(
+            chunk, comment_flag, comment_string
+        )
+        chunk = []
+
+        while len(pending) >= max_pending:
+            yield from pending.popleft().result()
+
+    if chunk:
+        pending.append(
+            executor.submit(
+                tokenize_chunk, chunk, comment_flag, comment_string
+            )
+        )
+        comment_flag, comment_string = scan_comment_state(
+            chunk, comment_flag, comment_string
+        )
+
+    while pending:
+        yield from pending.popleft().result()
+
+    program_status[multiline_comment_flag] = comment_flag
+    program_status[previous_comment_string] = comment_string
+
+
+def iter_results(token_lists, session=None):
+    """
+    Args:
+    <token_lists> = iterable of token lists, e.g. from iter_tokens()
+    <session> = session list from new_session(), default_session if None
+
+    Lazily actions each token list on <session> with process_tokens().
+    The session resource budget is NOT applied, lines have already been
+    parsed so use process_command() for budgeted sessions
+
+    Yields: List[] of (code, payload) output events for each line
+    """
+    if session is None:
+        session = default_session
+
+    for rpn_elements in token_lists:
+        yield process_tokens(rpn_elements, session, [])
+
+
+def iter_output(results):
+    """
+    <results> = iterable of output event lists, e.g. from iter_results()
+
+    Lazily renders each event list as process_command() would
+
+    Yields: <string> display output for each line, empty if none
+    """
+    for output_events in results:
+        yield render_events(output_events)[:-1]
+
+
+def process_commands_quietly(commands, session=None):
+    """
+    Args:
+    <commands> = iterable of input command strings
+    <session> = session list from new_session(), default_session if None
+
+    Actions <commands> in order on <session> without formatting any
+    display output, only the number of values and errors that would have
+    been displayed are counted. A session resource budget is enforced
+    by govern_command()
+
+    Returns:
+        <snapshot> (tuple) = final session state from snapshot_session(),
+        <value_count> (int) = values suppressed from '=' and 'd',
+        <error_count> (int) = error messages suppressed
+    """
+    if session is None:
+        session = default_session
+
+    program_status = session[session_status]
+    value_count = 0
+    error_count = 0
+
+    for command in commands:
+        if session[session_budget] is not None:
+            output_events = govern_command(command, session, [])
+        else:
+            output_events = process_tokens(
+                parse_command_line(command, program_status), session, []
+            )
+        for code, _ in output_events:
+            if code == value_event:
+                value_count += 1
+        error_count += len(output_events)
+
+    return snapshot_session(session), value_count, error_count - value_count
+
+
+def process_locked_command(session, command):
+    """
+    Args:
+    <session> = session list from new_session()
+    <command> = input command string
+
+    Actions <command> on <session> while holding the session lock
+
+    Returns: <string> process_command() output
+    """
+    with session[session_lock]:
+        return process_command(command, session)
+
+
+def process_session_commands(session, commands):
+    """
+    Args:
+    <session> = session list from new_session()
+    <commands> = list of input command strings
+
+    Actions <commands> in order on <session> while holding the session
+    lock, so no other executor job can use the session at the same time
+
+    Returns: List[] of process_command() outputs, one per command
+    """
+    with session[session_lock]:
+        return [process_command(command, session) for command in commands]
+
+
+def submit_command(executor, session, command):
+    """
+    Args:
+    <executor> = concurrent.futures executor, e.g. ThreadPoolExecutor
+    <session> = session list from new_session()
+    <command> = input command string
+
+    Submits a single (session, command) job to <executor>. Jobs on the
+    same session never run at the same time, but jobs submitted one by
+    one may run in any order, use map_commands() where order matters
+
+    Returns: <Future> resolving to the process_command() output
+    """
+    return executor.submit(process_locked_command, session, command)
+
+
+def map_commands(executor, jobs):
+    """
+    Args:
+    <executor> = concurrent.futures executor, e.g. ThreadPoolExecutor
+    <jobs> = iterable of (session, command) tuples
+
+    Actions <jobs> on <executor>. Commands for one session are run as one
+    executor job in the order given, different sessions run concurrently
+
+    Returns: List[] of process_command() outputs in the order of <jobs>
+    """
+    session_jobs = {}
+    job_order = []
+
+    # group commands by session keeping their original position
+    for session, command in jobs:
+        session_commands = session_jobs.setdefault(id(session), (session, []))
+        job_order.append((id(session), len(session_commands[1])))
+        session_commands[1].append(command)
+
+    futures = {
+        key: executor.submit(process_session_commands, session, commands)
+        for key, (session, commands) in session_jobs.items()
+    }
+    outputs = {key: future.result() for key, future in futures.items()}
+
+    return [outputs[key][position] for key, position in job_order]
+
+
+def generate_token_source(rpn_elements, checked):
+    """
+    Args:
+    <rpn_elements> = token list from parse_command_line()
+    <checked> (bool) = False to leave out the stack overflow, underflow
+    and empty checks, for use only where stack_effect() shows they
+    cannot fail
+
+    Generates python statements performing exactly the stack operations,
+    saturation checks and output events process_tokens() would for
+    <rpn_elements>. Operand values are converted and saturated here so
+    only the checks that depend on the stack remain
+
+    Returns: List[] of python source lines, unindented
+    """
+    source = []
+
+    for s in rpn_elements:
+        if s.startswith(comment_token) is True:
+            continue
+
+        if s in arithmetic_operators:
+            # (condition, error code) pairs checked before the operation
+            guards = []
+            if checked:
+                guards.append(("len(stack) < 2", stack_underflow_error))
+            if s in ["/", "%"]:
+                guards.append(("float(stack[-1]) == 0", zero_divide_error))
+            elif s == "^":
+                guards.append(("float(stack[-1]) < 1", negative_power_error))
+
+            statement = "if "
+            for condition, error_code in guards:
+                source.append(statement + condition + ":")
+                source.append(
+                    "    output_events.append((%d, None))" % error_code
+                )
+                statement = "elif "
+            operation_indent = ""
+            if guards:
+                source.append("else:")
+                operation_indent = "    "
+
+            source.append(operation_indent + "y = float(stack.pop())")
+            source.append(operation_indent + "x = float(stack.pop())")
+            source.append(operation_indent + "z = " + operator_expressions[s])
+            # popping two values means the push can never overflow
+            source.append(
+                operation_indent
+                + "stack.append(max(z, %d) if z < 0 else min(z, %d))"
+                % (min_nr, max_nr)
+            )
+            continue
+
+        # statements pushing the operand onto the stack
+        push_source = []
+
+        if s.startswith(rand_number_token) is True:
+            sign = "-" if s[len(rand_number_token) :].startswith("-") else ""
+            push_source.append("index = program_status[%d]" % random_index)
+            push_source.append("stack.append(%srandom_number[index])" % sign)
+            push_source.append("index += 1")
+            push_source.append("if index >= %d:" % len(random_number))
+            push_source.append("    index = 0")
+            push_source.append("program_status[%d] = index" % random_index)
+
+        elif s.startswith(number_token) is True or s.startswith(
+            octal_number_token
+        ):
+            # convert the operand with the interpreter defs on a scratch
+            # stack, an illegal Octal value leaves it empty and is ignored
+            value = []
+            if s.startswith(number_token) is True:
+                process_number(s[len(number_token) :], value)
+            else:
+                process_octal_number(s[len(octal_number_token) :], value)
+            if not value:
+                continue
+            push_source.append("stack.append(%r)" % value[0])
+
+        if push_source:
+            if checked:
+                source.append("if len(stack) + 1 > %d:" % stack_limit)
+                source.append(
+                    "    output_events.append((%d, None))"
+                    % stack_overflow_error
+                )
+                source.append("else:")
+                push_source = ["    " + line for line in push_source]
+            source += push_source
+            continue
+
+        if s == equals_operator:
+            if checked:
+                source.append("if stack:")
+                source.append(
+                    "    output_events.append((%d, stack[-1]))" % value_event
+                )
+                source.append("else:")
+                source.append(
+                    "    output_events.append((%d, None))" % stack_empty_error
+                )
+            else:
+                source.append(
+                    "output_events.append((%d, stack[-1]))" % value_event
+                )
+            continue
+
+        if s == display_stack_operator:
+            source.append("if stack:")
+            source.append(
+                "    output_events.extend([(%d, item) for item in stack])"
+                % value_event
+            )
+            source.append("else:")
+            source.append(
+                "    output_events.append((%d, %d))" % (value_event, min_nr)
+            )
+            continue
+
+        # if you reach here then it must be an illegal operator
+        source.append(
+            "output_events.append((%d, %r))" % (unrecognised_op_error, s)
+        )
+
+    return source
+
+
+def generate_command_source(rpn_elements):
+    """
+    <rpn_elements> = token list from parse_command_line()
+
+    Generates python source for a def specialized_command(stack,
+    program_status, output_events) which actions <rpn_elements>. When
+    the starting stack depth is within the bounds from stack_effect()
+    the statements without stack checks are run
+
+    Returns: <string> python source
+    """
+    required_depth, max_growth, _, _ = stack_effect(rpn_elements)
+
+    source = ["def specialized_command(stack, program_status, output_events):"]
+    source.append(
+        "    if %d <= len(stack) <= %d:"
+        % (required_depth, stack_limit - max_growth)
+    )
+    for line in generate_token_source(rpn_elements, False):
+        source.append("        " + line)
+    source.append("        return output_events")
+    for line in generate_token_source(rpn_elements, True):
+        source.append("    " + line)
+    source.append("    return output_events")
+
+    return "\n".join(source) + "\n"
+
+
+def specialize_command(command):
+    """
+    <command> = STR value containing input command(s)
+
+    Compiles <command>, as parsed from outside of a comment, into a
+    specialized python function using generate_command_source()
+
+    Returns: <list> [function, comment_flag, comment_string] where
+    function(stack, program_status, output_events) actions the command
+    and the comment values are the program status settings after it.
+    function is None if <command> has more than specialize_token_limit
+    tokens
+    """
+    # parse with scratch status settings so no session is changed
+    command_status = [0, False, ""]
+    rpn_elements = parse_command_line(command, command_status)
+
+    if len(rpn_elements) > specialize_token_limit:
+        return [
+            None,
+            command_status[multiline_comment_flag],
+            command_status[previous_comment_string],
+        ]
+
+    namespace = {
+        "process_power": process_power,
+        "random_number": random_number,
+    }
+    exec(  # pylint: disable=exec-used
+        compile(generate_command_source(rpn_elements), "<srpn>", "exec"),
+        namespace,
+    )
+
+    return [
+        namespace["specialized_command"],
+        command_status[multiline_comment_flag],
+        command_status[previous_comment_string],
+    ]
+
+
+def process_command_specialized(command, session=None):
+    """
+    Args:
+    <command> = STR value containing input command(s)
+    <session> = session list from new_session(), default_session if None
+
+    Opt-in replacement for process_command() for commands evaluated many
+    times. Once <command> has been seen specialize_threshold times it is
+    compiled by specialize_command() and later calls run the compiled
+    function instead of re-interpreting its tokens.
+
+    Only commands starting outside of a multiline comment are specialized,
+    the comment status is then always the same so the cache is keyed by
+    the command string alone. Other commands, commands over
+    specialize_token_limit tokens, commands seen once the cache is full
+    and every command on a session with a resource budget use
+    process_command()
+
+    Returns: <string> containing concatented list of display outputs
+    """
+    if session is None:
+        session = default_session
+    program_status = session[session_status]
+
+    # budgeted sessions are limited by process_command()
+    if (
+        program_status[multiline_comment_flag] is True
+        or session[session_budget] is not None
+    ):
+        return process_command(command, session)
+
+    # a single dict lookup or length is safe without the lock, a
+    # compiled command is never changed or removed once added
+    specialized = specialized_commands.get(command)
+
+    if specialized is None:
+        # the cache only grows, so once full no more counting is needed
+        if len(specialized_commands) >= specialize_cache_limit:
+            return process_command(command, session)
+
+        with specialize_lock:
+            hotness = command_hotness.get(command, 0) + 1
+            if hotness < specialize_threshold:
+                # forget old counts rather than let them grow without limit
+                if len(command_hotness) >= specialize_cache_limit:
+                    command_hotness.clear()
+                command_hotness[command] = hotness
+            else:
+                command_hotness.pop(command, None)
+
+        if hotness < specialize_threshold:
+            return process_command(command, session)
+
+        # compile without the lock so other commands are not held up
+        specialized = specialize_command(command)
+
+        with specialize_lock:
+            # keep the function another thread may have added meanwhile
+            if command in specialized_commands:
+                specialized = specialized_commands[command]
+            elif len(specialized_commands) < specialize_cache_limit:
+                specialized_commands[command] = specialized
+
+    if specialized[0] is None:
+        return process_command(command, session)
+
+    output_events = specialized[0](
+        session[session_stack], program_status, []
+    )
+    program_status[multiline_comment_flag] = specialized[1]
+    program_status[previous_comment_string] = specialized[2]
+
+    # return outputs as concatented string, stripping last trailing \n
+    return render_events(output_events)[:-1]
+
+
+def encode_varint(number):
+    """
+    <number> (int) = value >= 0
+
+    Encodes <number> as an unsigned LEB128 varint, 7 bits per byte with
+    the top bit set on every byte but the last
+
+    Returns: <bytes>
+    """
+    encoded = bytearray()
+
+    while number > 0x7F:
+        encoded.append((number & 0x7F) | 0x80)
+        number >>= 7
+    encoded.append(number)
+
+    return bytes(encoded)
+
+
+def decode_varint(data, position):
+    """
+    Args:
+    <data> (bytes) = trace data
+    <position> (int) = offset of the varint in <data>
+
+    Returns:
+        <number> (int) = decoded value,
+        <position> (int) = offset of the byte after the varint
+    """
+    number = 0
+    shift = 0
+
+    while True:
+        byte = data[position]
+        position += 1
+        number |= (byte & 0x7F) << shift
+        if byte < 0x80:
+            return number, position
+        shift += 7
+
+
+def encode_trace_text(text):
+    """
+    <text> (str) = command or output text
+
+    Returns: <bytes> varint length followed by the UTF-8 text
+    """
+    encoded = text.encode("utf-8", "surrogatepass")
+    return encode_varint(len(encoded)) + encoded
+
+
+def decode_trace_text(data, position):
+    """
+    Args:
+    <data> (bytes) = trace data
+    <position> (int) = offset of the text length varint in <data>
+
+    Returns:
+        <text> (str),
+        <position> (int) = offset of the byte after the text
+    """
+    length, position = decode_varint(data, position)
+    if position + length > len(data):
+        raise IndexError("truncated SRPN trace text")
+    text = data[position : position + length].decode("utf-8", "surrogatepass")
+    return text, position + length
+
+
+def new_trace_recorder(
+    trace_file, session=None, checkpoint_interval=1024, flush_size=65536
+):
+    """
+    Args:
+    <trace_file> = binary file opened for writing
+    <session> = session list from new_session(), default_session if None
+    <checkpoint_interval> (int) = commands between checkpoint records
+    <flush_size> (int) = bytes of records buffered before they are
+    written and flushed to <trace_file>. A crash loses at most this
+    many bytes of records, 0 writes every command so nothing is lost
+    at the cost of a write and flush per command
+
+    Starts a binary trace of the commands actioned on <session> by
+    process_command_recorded(), writing the header and a checkpoint of
+    the starting session state. Call write_trace_checkpoint() when
+    recording ends to write the final state and any buffered records
+
+    Returns: <recorder> list [file, session, checkpoint interval,
+    commands, seconds, buffer, flush size]
+    """
+    if session is None:
+        session = default_session
+
+    recorder = [
+        trace_file,
+        session,
+        checkpoint_interval,
+        0,
+        0.0,
+        bytearray(trace_magic),
+        flush_size,
+    ]
+    write_trace_checkpoint(recorder)
+
+    return recorder
+
+
+def write_trace_checkpoint(recorder):
+    """
+    <recorder> = trace recorder from new_trace_recorder()
+
+    Appends a checkpoint record holding the number of commands and
+    seconds so far and the state of the recorder session, then writes
+    all buffered records to the trace file
+    """
+    snapshot = snapshot_session(recorder[recorder_session])
+
+    record = recorder[recorder_buffer]
+    record.append(trace_checkpoint_record)
+    record += encode_varint(recorder[recorder_commands])
+    record += trace_double.pack(recorder[recorder_seconds])
+    record += encode_varint(snapshot[1])
+    record.append(1 if snapshot[2] is True else 0)
+    record += encode_trace_text(snapshot[3])
+    record += encode_varint(len(snapshot[0]))
+    for item in snapshot[0]:
+        record += trace_double.pack(item)
+
+    flush_trace(recorder)
+
+
+def flush_trace(recorder):
+    """
+    <recorder> = trace recorder from new_trace_recorder()
+
+    Writes all buffered records to the trace file and flushes it
+    """
+    recorder[recorder_file].write(recorder[recorder_buffer])
+    recorder[recorder_file].flush()
+    recorder[recorder_buffer] = bytearray()
+
+
+def process_command_recorded(command, recorder):
+    """
+    Args:
+    <command> = STR value containing input command(s)
+    <recorder> = trace recorder from new_trace_recorder()
+
+    As process_command() on the recorder session, appending a record of
+    <command> and its output to the trace and a checkpoint record every
+    checkpoint interval commands. Records are written to the trace file
+    once the recorder flush size is reached
+
+    Returns: <string> containing concatented list of display outputs
+    """
+    start_time = perf_counter()
+    output = process_command(command, recorder[recorder_session])
+    recorder[recorder_seconds] += perf_counter() - start_time
+
+    command_bytes = command.encode("utf-8", "surrogatepass")
+    output_bytes = output.encode("utf-8", "surrogatepass")
+
+    if len(command_bytes) < 0x80 and len(output_bytes) < 0x80:
+        # both lengths fit a single byte varint, the usual case
+        recorder[recorder_buffer] += b"%c%c%s%c%s" % (
+            trace_command_record,
+            len(command_bytes),
+            command_bytes,
+            len(output_bytes),
+            output_bytes,
+        )
+    else:
+        recorder[recorder_buffer] += (
+            bytes([trace_command_record])
+            + encode_trace_text(command)
+            + encode_trace_text(output)
+        )
+
+    recorder[recorder_commands] += 1
+    if recorder[recorder_commands] % recorder[recorder_interval] == 0:
+        write_trace_checkpoint(recorder)
+    elif len(recorder[recorder_buffer]) >= recorder[recorder_flush_size]:
+        flush_trace(recorder)
+
+    return output
+
+
+def decode_trace_checkpoint(data, position):
+    """
+    Args:
+    <data> (bytes) = trace data
+    <position> (int) = offset after the checkpoint record type
+
+    Returns:
+        <commands> (int) = commands recorded before the checkpoint,
+        <seconds> (float) = seconds spent actioning them,
+        <snapshot> (tuple) = session state as from snapshot_session(),
+        <position> (int) = offset of the next record
+    """
+    commands, position = decode_varint(data, position)
+    seconds = trace_double.unpack_from(data, position)[0]
+    position += trace_double.size
+    index, position = decode_varint(data, position)
+    comment_flag = data[position] == 1
+    comment_string, position = decode_trace_text(data, position + 1)
+    depth, position = decode_varint(data, position)
+
+    values = []
+    for _ in range(depth):
+        values.append(trace_double.unpack_from(data, position)[0])
+        position += trace_double.size
+
+    snapshot = (tuple(values), index, comment_flag, comment_string)
+    return commands, seconds, snapshot, position
+
+
+def replay_trace(data, process=process_command, max_divergences=100):
+    """
+    Args:
+    <data> (bytes) = complete trace written by a trace recorder
+    <process> = def(command, session) to replay with, e.g. the
+    process_command of another version of this module
+    <max_divergences> (int) = most divergences to report
+
+    Reruns every recorded command on a new session started from the
+    first checkpoint, comparing outputs with the recorded outputs and
+    session state with each later checkpoint. A trace cut short, e.g.
+    by a crash while recording, is replayed up to its last complete
+    record
+
+    Returns:
+        <commands> (int) = number of commands replayed,
+        <divergences> (list) = (command number, recorded, replayed)
+        tuples, outputs for commands or snapshots for checkpoints,
+        <timed_commands> (int) = commands up to the last checkpoint,
+        the only ones with a recorded time,
+        <recorded_seconds> (float) = seconds the recording spent
+        actioning the timed commands,
+        <replay_seconds> (float) = seconds spent replaying them,
+        <truncated_position> (int) = offset of an incomplete last
+        record, None if the trace is complete
+    """
+    if not data.startswith(trace_magic):
+        raise ValueError("not an SRPN trace")
+
+    session = new_session()
+    divergences = []
+    commands = 0
+    timed_commands = 0
+    recorded_seconds = 0.0
+    replay_seconds = 0.0
+    checkpoint_seconds = 0.0
+    truncated_position = None
+    position = len(trace_magic)
+
+    while position < len(data):
+        record_type = data[position]
+        record_position = position
+        position += 1
+
+        if record_type == trace_command_record:
+            # a record cut short raises IndexError before it is actioned
+            try:
+                command, position = decode_trace_text(data, position)
+                recorded_output, position = decode_trace_text(data, position)
+            except IndexError:
+                truncated_position = record_position
+                break
+
+            start_time = perf_counter()
+            output = process(command, session)
+            replay_seconds += perf_counter() - start_time
+            commands += 1
+
+            if output != recorded_output:
+                divergences.append((commands, recorded_output, output))
+
+        elif record_type == trace_checkpoint_record:
+            try:
+                (
+                    checkpoint_commands,
+                    checkpoint_recorded_seconds,
+                    snapshot,
+                    position,
+                ) = decode_trace_checkpoint(data, position)
+            except (IndexError, struct_error):
+                truncated_position = record_position
+                break
+            recorded_seconds = checkpoint_recorded_seconds
+
+            if checkpoint_commands == 0:
+                restore_session(session, snapshot)
+            elif snapshot_session(session) != snapshot:
+                divergences.append(
+                    (commands, snapshot, snapshot_session(session))
+                )
+            timed_commands = commands
+            checkpoint_seconds = replay_seconds
+
+        else:
+            raise ValueError("unknown SRPN trace record type")
+
+        if len(divergences) >= max_divergences:
+            break
+
+    # compare like for like, commands after the last checkpoint have no
+    # recorded time
+    return (
+        commands,
+        divergences,
+        timed_commands,
+        recorded_seconds,
+        checkpoint_seconds,
+        truncated_position,
+    )
+
+
+def replay_main(args):
+    """
+    <args> = command line arguments after --replay: <trace file>
+
+    Replays a trace file with replay_trace() and prints where the
+    outputs diverge and the recorded and replay throughput
+
+    Returns: <int> exit status, 1 if any divergence was found
+    """
+    if len(args) != 1:
+        print("usage: srpn.py --replay <trace file>")
+        return 2
+
+    with open(args[0], "rb") as trace_file:
+        data = trace_file.read()
+
+    (
+        commands,
+        divergences,
+        timed_commands,
+        recorded_seconds,
+        replay_seconds,
+        truncated_position,
+    ) = replay_trace(data)
+
+    print("commands replayed: %d" % commands)
+    if truncated_position is not None:
+        print(
+            "trace truncated, stopped at byte %d after command %d"
+            % (truncated_position, commands)
+        )
+    if recorded_seconds > 0 and replay_seconds > 0:
+        print(
+            "recorded lines/sec: %.0f" % (timed_commands / recorded_seconds)
+        )
+        print("replayed lines/sec: %.0f" % (timed_commands / replay_seconds))
+    for command_number, recorded, replayed in divergences:
+        print("divergence after command %d:" % command_number)
+        print("  recorded: %r" % (recorded,))
+        print("  replayed: %r" % (replayed,))
+
+    return 1 if divergences else 0
+
+
+def generate_workload_element(generator, mix):
+    """
+    Args:
+    <generator> = random.Random instance
+    <mix> = dict of workload element kind to relative weight
+
+    Generates one operand, operator or short sequence of the kind picked
+    from <mix>, see workload_mix for the kinds
+
+    Returns: <string>
+    """
+    kind = generator.choices(list(mix), list(mix.values()))[0]
+
+    if kind == "number":
+        return str(generator.randint(-1000, 1000))
+    if kind == "operator":
+        return generator.choice(arithmetic_operators)
+    if kind == "display":
+        return generator.choice([equals_operator, display_stack_operator])
+    if kind == "saturating":
+        return generator.choice(
+            [
+                str(max_nr + generator.randint(1, 1000)),
+                str(min_nr - generator.randint(1, 1000)),
+                "9" * generator.randint(11, 40),
+                "2147483647 2 *",
+                "-2147483648 1 -",
+            ]
+        )
+    if kind == "octal":
+        digits = "".join(
+            generator.choice("01234567")
+            for _ in range(generator.randint(1, 8))
+        )
+        # occasionally an illegal Octal value which is ignored
+        if generator.random() < 0.1:
+            digits += generator.choice("89")
+        return generator.choice(["0", "-0"]) + digits
+    if kind == "random":
+        return generator.choice(["r", "-r"])
+    if kind == "compact":
+        return "".join(
+            [
+                str(generator.randint(1, 99)),
+                generator.choice(arithmetic_operators),
+                str(generator.randint(1, 9)),
+                generator.choice(arithmetic_operators),
+                str(generator.randint(1, 9)),
+                generator.choice(["", equals_operator]),
+            ]
+        )
+    if kind == "comment":
+        return "# " + generator.choice(["note", "check total", "a b c"]) + " #"
+
+    # kind == "error"
+    return generator.choice(
+        ["1 0 /", "5 0 %", "2 0 ^", "x", "?", "+", "=", "d d", "0 0 0 0 0 0"]
+    )
+
+
+def generate_workload(line_count, seed=0, mix=None, max_line_elements=8):
+    """
+    Args:
+    <line_count> (int) = number of command lines to generate
+    <seed> = random seed, the same seed always gives the same lines
+    <mix> = dict of workload element kind to relative weight,
+    workload_mix if None
+    <max_line_elements> (int) = most elements on one line
+
+    Generates a synthetic SRPN script. Some lines open a multiline
+    comment which is closed a few lines later.
+
+    The mix pushes more than it pops, so each line is actioned on a
+    scratch session to track the stack depth, which is steered towards
+    a target depth picked afresh every few dozen lines by ending lines
+    with operators that drain the excess. Lines then run at depths
+    across the whole stack rather than at the stack limit
+
+    Yields: <string> command line
+    """
+    if mix is None:
+        mix = workload_mix
+
+    generator = Random(seed)
+    comment_lines = 0
+    # session the script is actioned on to track the stack depth
+    session = new_session()
+    target_depth = 0
+    target_lines = 0
+
+    for _ in range(line_count):
+        if comment_lines > 0:
+            comment_lines -= 1
+            # the last line of the comment closes it
+            line = "comment text" + (" #" if comment_lines == 0 else "")
+            process_command(line, session)
+            yield line
+            continue
+
+        if target_lines == 0:
+            target_depth = generator.randint(0, stack_limit)
+            target_lines = generator.randint(8, 64)
+        target_lines -= 1
+
+        line = " ".join(
+            generate_workload_element(generator, mix)
+            for _ in range(generator.randint(1, max_line_elements))
+        )
+        process_command(line, session)
+
+        # drain the stack down to the target depth, these operators
+        # always succeed
+        depth = len(session[session_stack])
+        if depth > max(target_depth, 1):
+            drain = " ".join(
+                generator.choice(["+", "-", "*"])
+                for _ in range(depth - max(target_depth, 1))
+            )
+            line += " " + drain
+            process_command(drain, session)
+
+        if generator.random() < mix.get("comment", 0) / sum(mix.values()) / 4:
+            comment_lines = generator.randint(1, 4)
+            line += " # multiline comment"
+            process_command(" # multiline comment", session)
+
+        yield line
+
+
+def run_benchmark(lines, session=None, process=process_command):
+    """
+    Args:
+    <lines> = list of input command strings
+    <session> = session list from new_session(), a new one if None
+    <process> = def(command, session) to time, e.g.
+    process_command_specialized
+
+    Times <process> on each of <lines>. Tokens are counted beforehand in
+    a separate untimed pass
+
+    Returns:
+        <seconds> (float) = total seconds actioning <lines>,
+        <token_count> (int) = tokens parsed from <lines>,
+        <latencies> (list) = sorted seconds for each line
+    """
+    if session is None:
+        session = new_session()
+
+    token_count = 0
+    for rpn_elements in iter_tokens(lines):
+        token_count += len(rpn_elements)
+
+    latencies = []
+    for command in lines:
+        start_time = perf_counter()
+        process(command, session)
+        latencies.append(perf_counter() - start_time)
+
+    latencies.sort()
+    return sum(latencies), token_count, latencies
+
+
+def measure_history_memory(entries, depth=12):
+    """
+    Args:
+    <entries> (int) = number of history entries to record
+    <depth> (int) = stack depth kept while recording, 1 to stack_limit
+
+    Records <entries> commands with process_command_with_history() on a
+    session holding <depth> stack values, tracing the memory allocated
+
+    Returns: <float> bytes of memory used per history entry
+    """
+    session = new_session()
+    process_command(" ".join(["1"] * depth), session)
+
+    tracemalloc.start()
+    start_memory = tracemalloc.get_traced_memory()[0]
+    for _ in range(entries):
+        # pushes and pops one value so the depth stays the same
+        process_command_with_history("1 +", session)
+    used_memory = tracemalloc.get_traced_memory()[0] - start_memory
+    tracemalloc.stop()
+
+    return used_memory / entries
+
+
+def measure_store_memory(capacity):
+    """
+    <capacity> (int) = number of session slots to create
+
+    Creates a session store with new_session_store(), tracing the
+    memory allocated, then times process_store_command() on slots
+    spread across the whole store
+
+    Returns:
+        <bytes_per_session> (float) = memory used per idle slot,
+        <peak_bytes_per_session> (float) = peak memory while creating,
+        <commands_per_second> (float)
+    """
+    tracemalloc.start()
+    store = new_session_store(capacity)
+    used_memory, peak_memory = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    session = new_session()
+    commands = min(capacity, 100000)
+    step = max(1, capacity // commands)
+    start_time = perf_counter()
+    for slot in range(0, commands * step, step):
+        process_store_command(store, slot, "1 2 + d", session)
+    seconds = perf_counter() - start_time
+
+    return used_memory / capacity, peak_memory / capacity, commands / seconds
+
+
+def bench_main(args):
+    """
+    <args> = command line arguments after --bench:
+    [--lines N] [--seed S] [--max-line-elements N]
+    [--path interpreter|specialized] [--distinct-lines N]
+    [--history-entries N [--history-depth D]] [--store-sessions N]
+
+    Runs run_benchmark() on a generated workload and prints lines/sec,
+    tokens/sec and p50/p99 line latency. --distinct-lines repeats only N
+    generated lines, as a hot workload would. --path specialized times
+    process_command_specialized() instead of process_command(), after
+    an untimed warm up so every distinct line is already compiled.
+    --history-entries instead measures the memory per undo history
+    entry with measure_history_memory(), --store-sessions the memory per
+    session slot of a session store with measure_store_memory()
+
+    Returns: <int> exit status
+    """
+    parser = ArgumentParser(prog="srpn.py --bench")
+    parser.add_argument("--lines", type=int, default=100000)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--max-line-elements", type=int, default=8)
+    parser.add_argument(
+        "--path", choices=["interpreter", "specialized"], default="interpreter"
+    )
+    parser.add_argument("--distinct-lines", type=int, default=0)
+    parser.add_argument("--history-entries", type=int, default=0)
+    parser.add_argument("--history-depth", type=int, default=12)
+    parser.add_argument("--store-sessions", type=int, default=0)
+    options = parser.parse_args(args)
+
+    if options.store_sessions:
+        bytes_per_session, peak_per_session, commands_per_second = (
+            measure_store_memory(options.store_sessions)
+        )
+        print("store sessions: %d" % options.store_sessions)
+        print("bytes/session: %.1f" % bytes_per_session)
+        print("peak bytes/session: %.1f" % peak_per_session)
+        print("store commands/sec: %.0f" % commands_per_second)
+        return 0
+
+    if options.history_entries:
+        print(
+            "history bytes/entry at depth %d: %.1f"
+            % (
+                options.history_depth,
+                measure_history_memory(
+                    options.history_entries, options.history_depth
+                ),
+            )
+        )
+        return 0
+
+    lines = list(
+        generate_workload(
+            options.distinct_lines or options.lines,
+            options.seed,
+            max_line_elements=options.max_line_elements,
+        )
+    )
+    if options.distinct_lines:
+        lines = [lines[i % len(lines)] for i in range(options.lines)]
+
+    if options.path == "specialized":
+        # warm up so each line is seen specialize_threshold times
+        warm_up_session = new_session()
+        for command in set(lines):
+            for _ in range(specialize_threshold):
+                process_command_specialized(command, warm_up_session)
+        seconds, token_count, latencies = run_benchmark(
+            lines, process=process_command_specialized
+        )
+    else:
+        seconds, token_count, latencies = run_benchmark(lines)
+
+    if not latencies or seconds == 0:
+        print("no lines actioned")
+        return 1
+
+    print("lines: %d, tokens: %d" % (len(lines), token_count))
+    print("lines/sec: %.0f" % (len(lines) / seconds))
+    print("tokens/sec: %.0f" % (token_count / seconds))
+    p99_index = min(len(latencies) - 1, len(latencies) * 99 // 100)
+    print("p50 latency: %.1f us" % (latencies[len(latencies) // 2] * 1e6))
+    print("p99 latency: %.1f us" % (latencies[p99_index] * 1e6))
+
+    return 0
+
+
+# Command line tools run instead of the calculator
+#   python srpn.py --replay <trace file>
+#   python srpn.py --bench [--lines N] [--seed S] [--max-line-elements N]
+#       [--path interpreter|specialized] [--distinct-lines N]
+#       [--history-entries N [--history-depth D]] [--store-sessions N]
+if __name__ == "__main__" and sys.argv[1:2] == ["--replay"]:
+    sys.exit(replay_main(sys.argv[2:]))
+if __name__ == "__main__" and sys.argv[1:2] == ["--bench"]:
+    sys.exit(bench_main(sys.argv[2:]))
 
 
 # Disable the pylint errors from this code below
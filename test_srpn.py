@@ -0,0 +1,538 @@
+"""
+Tests for the Saturated Reverse Polish Notation Calculator
+
+Run with: python -m unittest test_srpn   (or python -m pytest)
+"""
+
+import sys
+import unittest
+from io import BytesIO
+from concurrent.futures import ThreadPoolExecutor
+from random import Random
+
+import srpn
+
+# command lines mixing every kind of operator, operand, error and comment
+stress_commands = [
+    "1 2 + =",
+    "3 4 * 5 - d",
+    "r -r + =",
+    "10 3 / 7 % =",
+    "2 0 / 5 0 % 2 0 ^",
+    "017 -012 + =",
+    "2147483647 1 + =",
+    "-2147483648 1 - =",
+    "1+2*3^2=",
+    "x ? + =",
+    "# open comment",
+    "still inside 1 2 3",
+    "closed # 4 5 + =",
+    "1 # inline # 2 + =",
+    "d",
+    "= =",
+    "1 1 1 1 1 1 1 1 1 1 1 1 1 1 1 1 1 1 1 1 1 1 1 1",
+    "+ + + + + + + + + + + + + + + + + + + + + + + +",
+]
+
+
+class TestSessionThreadSafety(unittest.TestCase):
+    """
+    Actions many sessions from a thread pool under contention and checks
+    the outputs and final session states match a sequential run
+    """
+
+    session_count = 64
+    job_count = 20000
+
+    def setUp(self):
+        # switch threads as often as possible to provoke interleaving
+        self.switch_interval = sys.getswitchinterval()
+        sys.setswitchinterval(1e-6)
+
+    def tearDown(self):
+        sys.setswitchinterval(self.switch_interval)
+
+    def make_jobs(self, sessions, seed):
+        generator = Random(seed)
+        return [
+            (generator.choice(sessions), generator.choice(stress_commands))
+            for _ in range(self.job_count)
+        ]
+
+    def sequential_run(self, sessions, jobs):
+        reference = {id(session): srpn.new_session() for session in sessions}
+        outputs = [
+            srpn.process_command(command, reference[id(session)])
+            for session, command in jobs
+        ]
+        return reference, outputs
+
+    def assert_same_state(self, sessions, reference):
+        for session in sessions:
+            expected = reference[id(session)]
+            self.assertEqual(
+                session[srpn.session_stack], expected[srpn.session_stack]
+            )
+            self.assertEqual(
+                session[srpn.session_status], expected[srpn.session_status]
+            )
+
+    def test_map_commands_matches_sequential_run(self):
+        sessions = [srpn.new_session() for _ in range(self.session_count)]
+        jobs = self.make_jobs(sessions, 1)
+
+        with ThreadPoolExecutor(16) as executor:
+            outputs = srpn.map_commands(executor, jobs)
+
+        reference, expected = self.sequential_run(sessions, jobs)
+        self.assertEqual(outputs, expected)
+        self.assert_same_state(sessions, reference)
+
+    def test_submit_command_matches_sequential_run(self):
+        sessions = [srpn.new_session() for _ in range(self.session_count)]
+        jobs = self.make_jobs(sessions, 2)
+
+        # submit_command does not order jobs on one session, so each
+        # session gets its lines from its own thread in sequence
+        session_jobs = {id(session): [] for session in sessions}
+        for session, command in jobs:
+            session_jobs[id(session)].append((session, command))
+
+        def run_session(job_list):
+            with ThreadPoolExecutor(1) as inner:
+                return [
+                    srpn.submit_command(inner, session, command).result()
+                    for session, command in job_list
+                ]
+
+        with ThreadPoolExecutor(16) as executor:
+            futures = {
+                key: executor.submit(run_session, job_list)
+                for key, job_list in session_jobs.items()
+            }
+            session_outputs = {
+                key: future.result() for key, future in futures.items()
+            }
+
+        reference, expected = self.sequential_run(sessions, jobs)
+        positions = {key: 0 for key in session_jobs}
+        for (session, _), expected_output in zip(jobs, expected):
+            key = id(session)
+            self.assertEqual(
+                session_outputs[key][positions[key]], expected_output
+            )
+            positions[key] += 1
+        self.assert_same_state(sessions, reference)
+
+    def test_default_session_untouched(self):
+        before = (list(srpn.stack), list(srpn.program_status))
+        sessions = [srpn.new_session() for _ in range(self.session_count)]
+
+        with ThreadPoolExecutor(16) as executor:
+            srpn.map_commands(executor, self.make_jobs(sessions, 3))
+
+        self.assertEqual((srpn.stack, srpn.program_status), before)
+
+
+class TestSpecializedCommands(unittest.TestCase):
+    """
+    Checks compiled commands give the same outputs and session state as
+    interpreting them, before and after they are specialized
+    """
+
+    def test_matches_process_command(self):
+        long_command = " ".join(["1 2 + d"] * srpn.specialize_token_limit)
+        commands = stress_commands + [long_command]
+        session = srpn.new_session()
+        reference = srpn.new_session()
+
+        for _ in range(srpn.specialize_threshold * 2):
+            for command in commands:
+                self.assertEqual(
+                    srpn.process_command_specialized(command, session),
+                    srpn.process_command(command, reference),
+                    command,
+                )
+                self.assertEqual(
+                    session[srpn.session_stack],
+                    reference[srpn.session_stack],
+                )
+                self.assertEqual(
+                    session[srpn.session_status],
+                    reference[srpn.session_status],
+                )
+
+        self.assertIn("1 2 + =", srpn.specialized_commands)
+        self.assertIsNone(srpn.specialized_commands[long_command][0])
+
+
+class TestUncheckedTokens(unittest.TestCase):
+    """
+    Checks the unchecked fast path gives the same events and session
+    state as the checked loop wherever stack_effect() allows it
+    """
+
+    def test_matches_checked_loop(self):
+        generator = Random(5)
+        pieces = ["1", "-7", "0", "2147483647", "017", "089", "r", "-r"]
+        pieces += srpn.arithmetic_operators + ["=", "d", "x"]
+        compared = 0
+
+        while compared < 2000:
+            depth = generator.randint(0, srpn.stack_limit)
+            values = [generator.randint(-50, 50) for _ in range(depth)]
+            command = " ".join(
+                generator.choice(pieces)
+                for _ in range(generator.randint(1, 12))
+            )
+            rpn_elements = srpn.parse_command_line(command, [0, False, ""])
+            required_depth, max_growth, _, _ = srpn.stack_effect(
+                rpn_elements
+            )
+            if not required_depth <= depth <= srpn.stack_limit - max_growth:
+                continue
+            compared += 1
+
+            checked = srpn.new_session()
+            unchecked = srpn.new_session()
+            checked[srpn.session_stack].extend(values)
+            unchecked[srpn.session_stack].extend(values)
+            self.assertEqual(
+                srpn.process_tokens_unchecked(rpn_elements, unchecked, []),
+                srpn.process_tokens_checked(rpn_elements, checked, []),
+                command,
+            )
+            self.assertEqual(
+                unchecked[srpn.session_stack], checked[srpn.session_stack]
+            )
+            self.assertEqual(
+                unchecked[srpn.session_status], checked[srpn.session_status]
+            )
+
+
+class TestSessionHistory(unittest.TestCase):
+    """
+    Checks undo history, branched sessions and speculative commands
+    restore the session state they started from
+    """
+
+    def test_undo_to_empty_state(self):
+        session = srpn.new_session()
+        empty = srpn.snapshot_session(session)
+        for command in ["1 2 +", "# open", "r closed # 3"]:
+            srpn.process_command_with_history(command, session)
+
+        for _ in range(3):
+            self.assertTrue(srpn.undo_command(session))
+        self.assertEqual(srpn.snapshot_session(session), empty)
+        self.assertFalse(srpn.undo_command(session))
+        self.assertEqual(srpn.snapshot_session(session), empty)
+
+    def test_branch_undo_past_fork(self):
+        session = srpn.new_session()
+        srpn.process_command_with_history("1 2", session)
+        first = srpn.snapshot_session(session)
+        srpn.process_command_with_history("3 r", session)
+        parent = srpn.snapshot_session(session)
+
+        branch = srpn.branch_session(session)
+        srpn.process_command_with_history("+ +", branch)
+        for _ in range(2):
+            self.assertTrue(srpn.undo_command(branch))
+        self.assertEqual(srpn.snapshot_session(branch), first)
+
+        self.assertEqual(srpn.snapshot_session(session), parent)
+        self.assertTrue(srpn.undo_command(session))
+        self.assertEqual(srpn.snapshot_session(session), first)
+
+    def test_speculative_error_rolls_back(self):
+        session = srpn.new_session()
+        self.assertEqual(
+            srpn.process_command_speculative("5 r =", session),
+            ("1804289383", True),
+        )
+        before = srpn.snapshot_session(session)
+
+        # the random number and comment opened before the error are
+        # rolled back too
+        self.assertEqual(
+            srpn.process_command_speculative("7 r 0 / # left open", session),
+            ("Divide by 0.", False),
+        )
+        self.assertEqual(srpn.snapshot_session(session), before)
+        self.assertEqual(srpn.process_command("r =", session), "846930886")
+
+
+class TestSessionStore(unittest.TestCase):
+    """
+    Checks sessions held in a session store give the same outputs and
+    state as list sessions, without changing neighbouring slots
+    """
+
+    def load_snapshot(self, store, slot):
+        session = srpn.new_session()
+        srpn.load_session(store, slot, session)
+        return srpn.snapshot_session(session)
+
+    def test_round_trip_matches_list_sessions(self):
+        store = srpn.new_session_store(5)
+        empty = self.load_snapshot(store, 0)
+        work_session = srpn.new_session()
+        reference = {slot: srpn.new_session() for slot in (1, 2, 3)}
+
+        generator = Random(6)
+        jobs = [
+            (generator.choice(list(reference)), command)
+            for command in stress_commands * 20
+        ]
+        # leave slot 2 inside an open multiline comment
+        jobs += [(2, "1 2 d"), (2, "3 # open comment"), (2, "more text")]
+
+        for slot, command in jobs:
+            self.assertEqual(
+                srpn.process_store_command(
+                    store, slot, command, work_session
+                ),
+                srpn.process_command(command, reference[slot]),
+            )
+
+        for slot, session in reference.items():
+            self.assertEqual(
+                self.load_snapshot(store, slot),
+                srpn.snapshot_session(session),
+            )
+        self.assertTrue(self.load_snapshot(store, 2)[2])
+        self.assertEqual(self.load_snapshot(store, 0), empty)
+        self.assertEqual(self.load_snapshot(store, 4), empty)
+
+
+class TestSessionBudget(unittest.TestCase):
+    """
+    Checks every entry point that actions a command on a session applies
+    the session resource budget
+    """
+
+    def new_budgeted_session(self):
+        return srpn.new_session(
+            srpn.new_budget(line_length=10, tokens=3, session_operations=5)
+        )
+
+    def test_process_command(self):
+        session = self.new_budgeted_session()
+        self.assertEqual(
+            srpn.process_command("1 2 3 4 5 6 7 8 9", session),
+            "Budget exceeded.",
+        )
+        self.assertEqual(session[srpn.session_stack], [])
+
+    def test_process_command_speculative(self):
+        session = self.new_budgeted_session()
+        self.assertEqual(
+            srpn.process_command_speculative("1 2 3 4 5 6 7 8 9", session),
+            ("Budget exceeded.", False),
+        )
+        self.assertEqual(session[srpn.session_stack], [])
+
+    def test_process_command_specialized(self):
+        session = self.new_budgeted_session()
+        for _ in range(srpn.specialize_threshold * 2):
+            output = srpn.process_command_specialized("1 2 3 4", session)
+            session[srpn.session_stack].clear()
+        self.assertEqual(output, "Budget exceeded.")
+
+    def test_token_limit_keeps_comment_state(self):
+        session = self.new_budgeted_session()
+        self.assertEqual(
+            srpn.process_command("1 2 3 4 # open", session),
+            "Budget exceeded.",
+        )
+        self.assertEqual(session[srpn.session_status], [0, False, ""])
+        self.assertEqual(srpn.process_command("5 =", session), "5")
+
+    def test_branch_keeps_usage(self):
+        session = self.new_budgeted_session()
+        srpn.process_command("1 2 +", session)
+        srpn.process_command("1 1", session)
+        branch = srpn.branch_session(session)
+        self.assertEqual(srpn.process_command("1", branch), "Budget exceeded.")
+
+
+class TestQuietCommands(unittest.TestCase):
+    """
+    Checks quiet mode counts the values and errors process_command()
+    displays and leaves the same session state
+    """
+
+    def count_outputs(self, commands, session):
+        value_count = 0
+        error_count = 0
+        for command in commands:
+            for line in srpn.process_command(command, session).splitlines():
+                if line.lstrip("-").isdigit():
+                    value_count += 1
+                else:
+                    error_count += 1
+        return value_count, error_count
+
+    def test_matches_process_command(self):
+        session = srpn.new_session()
+        reference = srpn.new_session()
+        value_count, error_count = self.count_outputs(
+            stress_commands, reference
+        )
+        self.assertEqual(
+            srpn.process_commands_quietly(stress_commands, session),
+            (srpn.snapshot_session(reference), value_count, error_count),
+        )
+
+    def test_budget_applied(self):
+        budget = srpn.new_budget(tokens=1, session_operations=1)
+        commands = ["1 2 3 4 5"] * 3
+        reference = srpn.new_session(budget)
+        value_count, error_count = self.count_outputs(commands, reference)
+        snapshot, values, errors = srpn.process_commands_quietly(
+            commands, srpn.new_session(budget)
+        )
+        self.assertEqual(snapshot[0], ())
+        self.assertEqual(
+            (snapshot, values, errors),
+            (srpn.snapshot_session(reference), value_count, error_count),
+        )
+
+
+class TestOperatorEdgeCases(unittest.TestCase):
+    """
+    Checks operands and operators which previously stopped a line or
+    raised an exception
+    """
+
+    def run_command(self, command):
+        return srpn.process_command(command, srpn.new_session())
+
+    def test_illegal_octal_ignored(self):
+        self.assertEqual(self.run_command("089 1 ="), "1")
+        self.assertEqual(self.run_command("1 089 2 + ="), "3")
+
+    def test_power_overflow_saturates(self):
+        self.assertEqual(self.run_command("2 2147483647 ^ ="), "2147483647")
+        self.assertEqual(
+            self.run_command("-2 2147483647 ^ ="), "-2147483648"
+        )
+
+    def test_negative_base_fractional_exponent_truncated(self):
+        self.assertEqual(srpn.process_power(-8.0, 2.5), 64.0)
+        self.assertEqual(srpn.process_power(-2.0, 3.9), -8.0)
+        self.assertEqual(self.run_command("-8 5 2 / ^ ="), "64")
+
+    def test_random_sequence_wraps(self):
+        count = len(srpn.random_number)
+        self.assertEqual(count, 22)
+        output = self.run_command(" ".join(["r"] * (count + 1)) + " d")
+        self.assertEqual(
+            output.splitlines(),
+            [str(number) for number in srpn.random_number] + ["1804289383"],
+        )
+
+
+class TestNumberLiterals(unittest.TestCase):
+    """
+    Checks very long literals saturate on both the checked and the
+    unchecked token paths
+    """
+
+    def test_long_literals_saturate(self):
+        long_digits = "9" * 100000
+        command = "%s -%s 0%s d" % (long_digits, long_digits, "7" * 100000)
+        rpn_elements = srpn.parse_command_line(command, [0, False, ""])
+        expected = "2147483647\n-2147483648\n2147483647"
+
+        for process in (srpn.process_tokens, srpn.process_tokens_unchecked):
+            session = srpn.new_session()
+            output_events = process(rpn_elements, session, [])
+            self.assertEqual(
+                srpn.render_events(output_events)[:-1], expected
+            )
+
+
+class TestTraceRecording(unittest.TestCase):
+    """
+    Checks recorded commands reach the trace file as they are actioned
+    and a trace cut short replays up to its last complete record
+    """
+
+    def record(self, trace_file, commands, **settings):
+        recorder = srpn.new_trace_recorder(
+            trace_file, srpn.new_session(), **settings
+        )
+        for command in commands:
+            srpn.process_command_recorded(command, recorder)
+        return recorder
+
+    def test_records_written_every_command(self):
+        trace_file = BytesIO()
+        self.record(trace_file, stress_commands, flush_size=0)
+        # no final checkpoint, as if the recording process crashed
+        commands, divergences, _, _, _, truncated = srpn.replay_trace(
+            trace_file.getvalue()
+        )
+        self.assertEqual(commands, len(stress_commands))
+        self.assertEqual(divergences, [])
+        self.assertIsNone(truncated)
+
+    def test_rates_use_commands_to_last_checkpoint(self):
+        trace_file = BytesIO()
+        recorder = self.record(
+            trace_file, stress_commands, checkpoint_interval=8
+        )
+        srpn.flush_trace(recorder)
+        commands, _, timed_commands, _, _, _ = srpn.replay_trace(
+            trace_file.getvalue()
+        )
+        self.assertEqual(commands, len(stress_commands))
+        self.assertEqual(timed_commands, len(stress_commands) // 8 * 8)
+
+    def test_truncated_trace_replays_complete_records(self):
+        trace_file = BytesIO()
+        recorder = self.record(trace_file, stress_commands)
+        srpn.write_trace_checkpoint(recorder)
+        data = trace_file.getvalue()
+
+        for length in range(len(srpn.trace_magic) + 1, len(data)):
+            commands, divergences, _, _, _, truncated = srpn.replay_trace(
+                data[:length]
+            )
+            self.assertEqual(divergences, [])
+            if truncated is not None:
+                self.assertLess(truncated, length)
+                self.assertLessEqual(commands, len(stress_commands))
+
+
+class TestCommentScan(unittest.TestCase):
+    """
+    Checks the delimiter scan of parallel lexing finds the same comment
+    status as parsing every line
+    """
+
+    def test_scan_matches_parse(self):
+        generator = Random(4)
+        pieces = ["#", " ", "1", "+", "x", " # ", "# ", " #"]
+        for _ in range(20000):
+            lines = [
+                "".join(
+                    generator.choice(pieces)
+                    for _ in range(generator.randint(0, 6))
+                )
+                for _ in range(generator.randint(1, 4))
+            ]
+            command_status = [0, False, ""]
+            for line in lines:
+                srpn.parse_command_line(line, command_status)
+            self.assertEqual(
+                srpn.scan_comment_state(lines, False, ""),
+                tuple(command_status[1:]),
+                lines,
+            )
+
+
+if __name__ == "__main__":
+    unittest.main()